@@ -1,9 +1,7 @@
 import sys
 
-import threading
-import subprocess
-import time
 import argparse
+import remote
 
 
 
@@ -12,6 +10,8 @@ parser.add_argument('--no-yaml', dest='enable_yaml', action='store_false', help=
 parser.set_defaults(no_yaml=True)
 parser.add_argument('--user',  type=str, default="root", help='SSH user')
 parser.add_argument('--key',  type=str, default="~/.ssh/bootcamp", help='SSH key path, eg: ~/.ssh/bootcamp')
+parser.add_argument('--ssh_persist', type=int, default=300, help='keep the ssh connections open in background and reuse them for this long after their last use (in sec), across invocations of the tools. 0 to disable.')
+parser.add_argument('--max_connecting', type=int, default=50, help='maximum number of ssh connections being established at the same time.')
 parser.add_argument('--hosts',  type=str, default="127.0.0.1", help='list of machine you want to monitor, eg: 127.0.0.2,127.0.0.1')
 parser.add_argument('--files',  type=str, default="/etc/dse/cassandra/cassandra.yaml,/etc/dse/dse.yaml,/var/lib/datastax-agent/conf/address.yaml,/etc/dse/dse-env.sh,/etc/default/dse,/etc/dse/cassandra/cassandra-rackdc.properties,/etc/dse/cassandra/jvm.options,/etc/dse/cassandra/cassandra-env.sh,/etc/dse/cassandra/cqlshrc.default,/etc/dse/cassandra/logback.xml,/etc/dse/cassandra/jmxremote.password,/etc/dse/cassandra/hotspot_compiler,/etc/dse/spark/spark-env.sh,/etc/dse/spark/dse-spark-env.sh,/etc/dse/spark/java-opts,/etc/dse/spark/spark-defaults.conf",
                     help='list of files to compare, eg: /etc/dse/cassandra/cassandra.yaml,/etc/dse/dse.yaml,/var/lib/datastax-agent/conf/address.yaml')
@@ -51,23 +51,12 @@ class BColors:
 colors = [BColors.Green, BColors.Blue, BColors.Cyan, BColors.Yellow, BColors.Magenta, BColors.Grey]
 
 #Execute the given command on all the nodes, asynch. Call the given method as soon as une ssh answer.
-def executeForAllHostAsynch(command, method, wait = True):
-    def collect(host,command):
-        command = 'ssh -o "StrictHostKeyChecking no" '+("" if args.key == "" else "-i "+args.key+" ") + args.user+'@'+host+' "'+command+'"'
-        p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        lines = p.stdout.readlines()
-        method(host, lines)
-
-    threads = []
+#All the ssh outputs are read from a single thread (see remote.py).
+def executeForAllHostAsynch(command, method):
+    commands = []
     for host in args.hosts:
-        t = threading.Thread(target=collect, args=(host,command,))
-        t.start()
-        threads.append(t)
-        time.sleep(0.2)
-    if wait:
-        for t in threads:
-            t.join()
-    return threads
+        commands.append((host, ssh.command(host, command)))
+    remote.run_commands(commands, method, args.max_connecting)
 
 def compare_checksum(file):
     command = "md5sum "+file+" | cut -d' ' -f 1"
@@ -96,7 +85,6 @@ def compare_checksum(file):
         print file+" ARE IDENTICAL ON ALL MACHINES"
 
 def compare_yaml(file):
-    mutex = threading.RLock()
     all_keys = set()
     host_params = {}
     files = {}
@@ -112,13 +100,9 @@ def compare_yaml(file):
     def process(host, lines):
         command_return = "\n".join(lines)
         yaml_file = yaml.load(command_return)
-        mutex.acquire()
-        try:
-            files[host] = yaml_file
-            host_params[host] = {}
-            build_keys(host, yaml_file, "")
-        finally:
-            mutex.release()
+        files[host] = yaml_file
+        host_params[host] = {}
+        build_keys(host, yaml_file, "")
 
     executeForAllHostAsynch('cat '+file, process)
 
@@ -161,6 +145,10 @@ def compare_yaml(file):
             print line
 
 
+#Connect once to each host, all the files are then read through these connections
+ssh = remote.Ssh(args.user, args.key, args.ssh_persist)
+ssh.open_masters(args.hosts, args.max_connecting)
+
 for file in args.files:
     if args.enable_yaml and (file[-4:] == "yaml" or file[-3:] == "yml"):
         compare_yaml(file)
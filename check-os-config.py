@@ -1,12 +1,13 @@
-import subprocess
-import threading
 import re
 import argparse
 import sys
+import remote
 
 parser = argparse.ArgumentParser(description='Check os configuration on multiple nodes.')
 parser.add_argument('--user',  type=str, default="root", help='SSH user')
 parser.add_argument('--hosts',  type=str, default="127.0.0.1", help='list of machine you want to monitor, eg: 127.0.0.1,127.0.0.2')
+parser.add_argument('--ssh_persist', type=int, default=300, help='keep the ssh connections open in background and reuse them for this long after their last use (in sec), across invocations of the tools. 0 to disable.')
+parser.add_argument('--max_connecting', type=int, default=50, help='maximum number of ssh connections being established at the same time.')
 parser.add_argument('--key',  type=str, default="", help='SSH key path, eg: ~/.ssh/id_rsa')
 parser.add_argument('--disks',  type=str, default="sda", help='list of disks to check, ex: sda,sdb')
 parser.add_argument('--local', dest='local_check', action='store_true', help='Execute check locally. Won\'t open a ssj connection')
@@ -75,68 +76,78 @@ def clean(line):
         return line[:-1]
     return line
 
-mutex = threading.RLock()
+def group_command(host, config, var):
+    all_command = ""
+    for command in config["commands"]:
+        if all_command != "":
+            all_command += " ; echo '__SEPARATOR__' ; "
+        command_name = "DSE_PID=$(ps -ef | grep DseMod | grep -v grep | awk '{{print $2}}' | head -n 1) ; "+command["command"].format(**var)
+        all_command += command_name
+    if args.local_check:
+        return all_command
+    return ssh.command(host, all_command)
 
-def analyse(host):
-    results = {}
-    for group_name, config  in commands.items():
-        vars = [{}] if "vars" not in config else config["vars"]
-        results[group_name] = []
-        for var in vars:
-            all_command = ""
-            for command in config["commands"]:
-                if all_command != "":
-                    all_command += " ; echo '__SEPARATOR__' ; "
-                command_name = "DSE_PID=$(ps -ef | grep DseMod | grep -v grep | awk '{{print $2}}' | head -n 1) ; "+command["command"].format(**var)
-                all_command += command_name
-            if args.local_check:
-                command_full = all_command
-            else:
-                command_full = 'ssh -qo "StrictHostKeyChecking no" '+("" if args.key == "" else "-i "+args.key+" ") + args.user+'@'+host+' "'+all_command+'"'
+def check_group(config, var, lines):
+    results = []
+    command_return = clean("".join(lines))
+    command_returns = command_return.split("__SEPARATOR__")
+    for idx, command in enumerate(config["commands"]):
+        command_name = " "+command["command"].format(**var)
+        command_return = command_returns[idx]
+        result = {"command": command_name, "value": command_return, "name": command["name"]}
+        if "equals" in command:
+            result.update({"type": "equals", "expected": command["equals"]})
+            result["state"] = "error" if command_return.replace("\n", "") != command["equals"].replace("\n", "") else "success"
+        elif "contains" in command:
+            result.update({"type": "contains", "expected": command["contains"]})
+            regexp = re.compile(r''+command["contains"])
+            result["state"] = "error" if regexp.search(command_return) is None else "success"
+        results.append(result)
+    return results
 
-            p = subprocess.Popen(command_full, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            lines = p.stdout.readlines()
-            command_return = clean("".join(lines))
-            command_returns = command_return.split("__SEPARATOR__")
-            for idx, command in enumerate(config["commands"]):
-                command_name = " "+command["command"].format(**var)
-                command_return = command_returns[idx]
-                result = {"command": command_name, "value": command_return, "name": command["name"]}
-                if "equals" in command:
-                    result.update({"type": "equals", "expected": command["equals"]})
-                    result["state"] = "error" if command_return.replace("\n", "") != command["equals"].replace("\n", "") else "success"
-                elif "contains" in command:
-                    result.update({"type": "contains", "expected": command["contains"]})
-                    regexp = re.compile(r''+command["contains"])
-                    result["state"] = "error" if regexp.search(command_return) is None else "success"
-                results[group_name].append(result)
-    re.sub('[ES]', 'a', s)
-    mutex.acquire()
-    try:
-        print "--------------------------------------------"
-        print "RESULT FOR "+args.user+"@"+host+":"
-        print "   "+"configuration".ljust(40, " ")+"\t "+"command".ljust(50, " ")+" \t\t"+"expectation".ljust(50, " ")+"\t\t "+"current value"
-        for k, values in results.items():
-            print k+" checks"
-            error = 0
+def report(host, results):
+    print "--------------------------------------------"
+    print "RESULT FOR "+args.user+"@"+host+":"
+    print "   "+"configuration".ljust(40, " ")+"\t "+"command".ljust(50, " ")+" \t\t"+"expectation".ljust(50, " ")+"\t\t "+"current value"
+    for k, values_by_var in results.items():
+        print k+" checks"
+        error = 0
+        for values in values_by_var:
             for v in values:
                 if v["state"] != "success":
                     print "   \033[91m"+(v["state"]+" "+v["name"]+":\033[0m").ljust(40, " ")+"\t "+v["command"].ljust(50, " ")+" \t\t"+v["expected"].ljust(50, " ")+"\t\t "+v["value"].replace("^\s*\n", ' ')
                     error = error +1
-            if error == 0:
-                print "Ok"
-    finally:
-        mutex.release()
+        if error == 0:
+            print "Ok"
+
+#Connect once to each host, all the check groups are then executed through these connections
+ssh = remote.Ssh(args.user, args.key, args.ssh_persist, options="-q")
+if not args.local_check:
+    ssh.open_masters(args.hosts, args.max_connecting)
 
-threads = []
+#One command per check group and disk for each host, all executed at once (see remote.py).
+#A host is reported as soon as all its checks are done.
+results = {}
+remaining = {}
+to_execute = []
 for host in args.hosts:
     print 'Checking host '+args.user+'@'+host+'...'
-    t = threading.Thread(target=analyse, args=(host,))
-    t.start()
-    threads.append(t)
-    #time.sleep(0.01)
-
-for t in threads:
-    t.join()
+    results[host] = {}
+    remaining[host] = 0
+    for group_name, config in commands.items():
+        vars = [{}] if "vars" not in config else config["vars"]
+        results[host][group_name] = [[] for var in vars]
+        for var_idx, var in enumerate(vars):
+            to_execute.append(((host, group_name, var_idx), group_command(host, config, var)))
+            remaining[host] += 1
 
+def process(key, lines):
+    host, group_name, var_idx = key
+    config = commands[group_name]
+    vars = [{}] if "vars" not in config else config["vars"]
+    results[host][group_name][var_idx] = check_group(config, vars[var_idx], lines)
+    remaining[host] -= 1
+    if remaining[host] == 0:
+        report(host, results[host])
 
+remote.run_commands(to_execute, process, args.max_connecting)
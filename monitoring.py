@@ -2,35 +2,103 @@
 #print call(["ulimit"]).read()
 import subprocess
 import os
-import threading
+import array
+import bisect
+import heapq
+import math
 import re
+import struct
+import fcntl
+import termios
+import collections
+import operator
+import fnmatch
+import warnings
+try:
+    import numpy
+except ImportError:
+    numpy = None
+import threading
 import time
 import datetime
 import csv
+import BaseHTTPServer
+import SocketServer
+import Queue
+import atexit
 import argparse
 import sys
+import remote
+import monitoring_recording
 parser = argparse.ArgumentParser(description='Display stats for multiple nodes')
 parser.add_argument('--hosts', type=str, default="127.0.0.1", help='list of machine you want to monitor, eg: 127.0.0.1,127.0.0.2')
 parser.add_argument('--user', type=str, default="root", help='SSH user')
 parser.add_argument('--key', type=str, default="", help='SSH key path, eg: ~/.ssh/id_rsa')
+parser.add_argument('--ssh_persist', type=int, default=300, help='keep the ssh connections open in background and reuse them for this long after their last use (in sec), across invocations of the tools. 0 to disable.')
 parser.add_argument('--dump', dest='dump_result', action='store_true', help='dump the result to a local csv file.')
 parser.set_defaults(dump_result=False)
 parser.add_argument('--dump_to', type=str, default="./monitoring-"+datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H:%M:%S')+".csv",
                     help='save the results to the given file. Not saved if empty')
+parser.add_argument('--dump_format',  type=str, default="csv", choices=["csv", "binary"], help='csv, or binary: compact recording of the same columns, faster to write and to analyse. Converted to csv with monitoring_recording.py.')
+parser.add_argument('--dump_flush',  type=int, default=5, help='the rows of the csv file are written in background and flushed to the disk every N sec.')
 parser.add_argument('--big-screen', dest='small_screen', action='store_false')
 parser.set_defaults(small_screen=True)
 parser.add_argument('--exclude-lo', dest='exclude_lo', action='store_true', help="Exclude l0 while reading rx and tx stats. Don't change the total failed/active connection.")
 parser.set_defaults(exclude_lo=False)
-parser.add_argument('--gc_log_file',  type=str, default="/var/log/cassandra/gc.log", help='gc log file path, eg: "/opt/cassandra/logs/gc.log.*.current".  Change to None or "" to disable')
+parser.add_argument('--gc_log_file',  type=str, default="/var/log/cassandra/gc.log", help='gc log file path, eg: "/opt/cassandra/logs/gc.log.*.current" (the most recent matching file is followed). Change to None or "" to disable')
 parser.add_argument('--log_file',  type=str, default="/var/log/system.log", help='cassandra log file path, eg: "/var/log/system.log". Count errors and warns. Change to None or "" to disable')
-parser.add_argument('--log_grep_freq',  type=int, default=10, help='error & warn use grep | wc to count errors on the log file. Change this value if you don\'t want to grep too often.')
+parser.add_argument('--log_grep_freq',  type=int, default=1, help='count the new errors & warns of the log file every N measures. Only the lines appended since the previous count are read.')
 parser.add_argument('--measure_frequency',  type=int, default=1, help='all other measure frequency (in sec).')
+parser.add_argument('--max_connecting', type=int, default=50, help='maximum number of ssh connections being established at the same time.')
+parser.add_argument('--connect_timeout', type=int, default=60, help='a connection which hasn\'t sent its first measure after this delay (in sec) is stopped and retried later, so that it doesn\'t keep its --max_connecting slot.')
+parser.add_argument('--max_retry_delay',  type=int, default=60, help='broken streams are retried after 1s, 2s, 4s... up to this delay (in sec).')
+parser.add_argument('--agent', dest='agent', action='store_true', help='Stream a python collector (monitoring_agent.py) to the nodes instead of the shell loop. Nothing is forked on the nodes at each measure. Requires python on the nodes.')
+parser.set_defaults(agent=False)
+parser.add_argument('--local', dest='local', action='store_true', help='Monitor this machine only, reading /proc directly in-process. Won\'t open a ssh connection.')
+parser.set_defaults(local=False)
+parser.add_argument('--benchmark', dest='benchmark', action='store_true', help='Measure the cost of reading and parsing one measure of a host with 64 cores and 40 block devices, then exit.')
+parser.set_defaults(benchmark=False)
+parser.add_argument('--history',  type=int, default=900, help='keep the cpu, avgqu-sz, awaits and gc pauses of the last N sec of each host, for the 1m/5m/15m averages, max and p99 (--view=history). 0 to disable.')
+parser.add_argument('--view',  type=str, default="default", choices=["default", "history", "devices", "cores"], help='default: last measure of each host. history: 1m/5m/15m averages, 15m max and p99 of the cpu, avgqu-sz, awaits and gc pauses. devices: one line per device (see --devices). cores: one line per core.')
+parser.add_argument('--devices',  type=str, default="", help='devices of the per device view and of the %%util column, eg: "sd*,nvme0n1". Default to the devices of --data_dirs, or all the disks if none is found.')
+parser.add_argument('--core_threshold',  type=float, default=0.9, help='cores busier than this (0 -> 1) are counted in the hot column. --view=cores displays each core.')
+parser.add_argument('--data_dirs',  type=str, default="/var/lib/cassandra/data,/var/lib/cassandra/commitlog", help='cassandra data and commitlog directories, their devices are selected by default (see --devices). Change to "" to disable')
+parser.add_argument('--dump_history', dest='dump_history', action='store_true', help='add the 1m/5m/15m averages, 15m max and p99 to each row of the csv file.')
+parser.set_defaults(dump_history=False)
+parser.add_argument('--no-summary', dest='summary', action='store_false', help="don't display the cluster summary rows (total/avg, min, median, p95, max and outliers) above the hosts. Uses numpy if installed.")
+parser.set_defaults(summary=True)
+parser.add_argument('--max_fps',  type=float, default=4, help='the display is refreshed when new measures are received, at most this many times per second.')
+parser.add_argument('--record_raw',  type=str, default="", help='record the frames received from the hosts (raw /proc content, with their reception time) to this file, to replay them later with --replay.')
+parser.add_argument('--replay',  type=str, default="", help='replay a file recorded with --record_raw instead of connecting to the hosts: the frames are parsed and displayed (and dumped with --dump) as if they were received again. With --benchmark, measure the parsing of its frames.')
+parser.add_argument('--replay_speed',  type=float, default=1, help='speed of the replay: 1 for the speed of the recording, 10 for 10 times faster, 0 for as fast as possible.')
+parser.add_argument('--metrics_port',  type=int, default=0, help='serve the last measure of each host in the OpenMetrics (prometheus) text format on http://<metrics_address>:<port>/metrics. 0 to disable.')
+parser.add_argument('--metrics_address',  type=str, default="127.0.0.1", help='address of the --metrics_port endpoint, 0.0.0.0 to accept scrapes from other machines.')
+parser.add_argument('--agent_python',  type=str, default="", help='python executable used to run the agent on the nodes. Default to python3 or python, whichever is found first.')
 
 args = parser.parse_args()
 
 if len(args.hosts) == 0:
     sys.exit('Hosts missing. Add host using --host=127.0.0.1,127.0.0.2')
 args.hosts = args.hosts.replace(" ", "").split(",")
+if args.local:
+    args.hosts = ["localhost"]
+#Start of the first line of the files written by --record_raw (see RawWriter)
+RAW_MAGIC = "MONRAW1 "
+if args.replay != "":
+    #The first line of the recording lists the hosts
+    try:
+        with open(args.replay, 'rb') as replay_file:
+            first_line = replay_file.readline()
+    except IOError as ex:
+        sys.exit("Can't read "+args.replay+": "+ex.strerror)
+    if not first_line.startswith(RAW_MAGIC):
+        sys.exit(args.replay+" isn't a recording of --record_raw (csv and binary dumps are read with monitoring_analysis.py and monitoring_recording.py)")
+    args.hosts = first_line[len(RAW_MAGIC):].strip().split(",")
+elif args.benchmark:
+    args.hosts = ["benchmark"]
+if args.dump_format == "binary" and args.dump_to == parser.get_default("dump_to"):
+    args.dump_to = args.dump_to[:-len(".csv")]+".rec"
+device_patterns = [pattern for pattern in args.devices.replace(" ", "").split(",") if pattern != ""]
 
 
 class BColors:
@@ -43,42 +111,133 @@ class BColors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+#Derived metrics kept in the history of each host, and the windows (in sec) of the rolling averages
+HISTORY_METRICS = ("cpu", "avgqu-sz", "r_await", "w_await", "gc_total_ms")
+HISTORY_WINDOWS = (60, 300, 900)
+HISTORY_THRESHOLDS = {"cpu": (0.7, 0.9), "avgqu-sz": (10, 100), "r_await": (30, 100), "w_await": (30, 100), "gc_total_ms": (100, 500)}
+HISTORY_COLUMNS = ("avg_1m", "avg_5m", "avg_15m", "max_15m", "p99_15m")
+
+class History(object):
+    #Derived metrics of the last measures of a host, in fixed size ring buffers (one array of doubles per metric,
+    #plus the timestamps), so keeping 15 min of measures costs the same memory after 15 min or after a week.
+    __slots__ = ("size", "count", "idx", "timestamps", "values")
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.idx = 0
+        self.timestamps = array.array('d', [0]) * size
+        self.values = dict((metric, array.array('d', [0]) * size) for metric in HISTORY_METRICS)
+
+    def append(self, timestamp, values):
+        self.timestamps[self.idx] = timestamp
+        for metric, value in zip(HISTORY_METRICS, values):
+            self.values[metric][self.idx] = value
+        self.idx = (self.idx + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def window(self, metric, seconds):
+        #Values measured during the last seconds. The timestamps are sorted in the 2 parts of the ring ([idx, size[ then
+        #[0, idx[), so the start of the window is found with a bisect and the values are 2 slices at most.
+        if self.count == 0:
+            return []
+        since = self.timestamps[self.idx - 1] - seconds * 1000
+        values = self.values[metric]
+        start = bisect.bisect_right(self.timestamps, since, 0, self.idx)
+        if start > 0 or self.count < self.size:
+            return values[start:self.idx]
+        start = bisect.bisect_right(self.timestamps, since, self.idx, self.size)
+        return values[start:] + values[:self.idx]
+
+    def stats(self, metric, seconds):
+        #avg, max and p99 (nearest rank) of the window, -1 if there is no measure. The unknown values (NaN) are ignored.
+        values = [value for value in self.window(metric, seconds) if value == value]
+        if len(values) == 0:
+            return -1, -1, -1
+        rank = len(values) - int(math.ceil(0.99 * len(values))) + 1
+        return sum(values) / len(values), max(values), heapq.nlargest(rank, values)[-1]
+
+    def summary(self, metric):
+        #1m, 5m and 15m averages, then the 15m max and p99
+        averages = [self.stats(metric, seconds)[0] for seconds in HISTORY_WINDOWS[:-1]]
+        average, maximum, p99 = self.stats(metric, HISTORY_WINDOWS[-1])
+        return averages + [average, maximum, p99]
+
+#Counters summed over all the devices and interfaces, in the order of Host.derived_values
+DEVICE_STATS = ("read_completed", "sectors_read", "time_spent_reading", "write_completed", "sectors_written", "time_spent_writing", "weighted_io_time")
+DEVICE_GETTER = operator.attrgetter(*(DEVICE_STATS + ("io_time",)))
+#Prefixes of the virtual block devices: loop devices, ram disks, compressed ram disks and cdroms
+VIRTUAL_DEVICES = ("loop", "ram", "zram", "sr")
+INTERFACE_STATS = ("rx_bytes", "rx_ok", "rx_error", "rx_dropped", "rx_overrun", "tx_bytes", "tx_ok", "tx_error", "tx_dropped", "tx_overrun")
+
+#Immutable copy of the derived metrics of the last measure of a host, replaced at each measure (see Host.publish) and read
+#by the display and the csv dump without lock
+Snapshot = collections.namedtuple("Snapshot", ["name", "timestamp", "derived", "worst_device", "devices_derived", "cores_derived", "history_summary"])
+
 class Host:
     def __init__(self, name):
-        self.mutex = threading.RLock()
-        self.acq = 0
         self.name = name
-        self.devices = []
-        self.previous_devices = []
+        #The counters of the last 2 measures. Devices and interfaces are stored by name, and the objects of the measure
+        #before the previous one are updated in place by the new measure (see reset), so steady-state collection
+        #doesn't allocate new objects.
+        self.generation = 0
+        self.devices = {}
+        self.previous_devices = {}
         self.cpu = None
         self.previous_cpu = None
+        self.spare_cpu = None
         self.timestamp = -1
         self.previous_timestamp = -1
-        self.interfaces = []
-        self.previous_interfaces = []
+        self.interfaces = {}
+        self.previous_interfaces = {}
+        #Core of each cpuN line, by name
+        self.cores = {}
+        self.previous_cores = {}
         self.connection_active = -1
         self.previous_connection_active = -1
         self.connection_failed = -1
         self.previous_connection_failed = -1
-        self.jvm_stop = -1
+        #stop the world pauses during the last measure
+        self.gc_count = 0
+        self.gc_total = 0
+        self.gc_max = 0
+        #errors & warns logged during the last log_grep_freq measures
         self.error_count = -1
-        self.previous_error_count = 0
         self.warn_count = -1
-        self.previous_warn_count = 0
+        self.history = History(int(math.ceil(float(args.history) / args.measure_frequency))) if args.history > 0 else None
+        #Derived metrics of the last measure (columns of CLUSTER_COLUMNS), None until 2 complete measures are received.
+        #Read by the display, the csv dump and the cluster summary, replaced by the next measure.
+        self.derived = None
+        self.snapshot = Snapshot(name, -1, None, "", (), (), None)
+        #Devices of the per device view (name, data directories) and their derived metrics (name, data directories, DEVICE_COLUMNS)
+        self.dirs = ""
+        self.selected_devices = []
+        self.devices_derived = []
+        self.worst_device = ""
+        #Derived metrics of each core (name, CORE_COLUMNS)
+        self.cores_derived = []
 
     def reset(self):
+        self.generation += 1
+        self.derived = None
+        self.devices_derived = []
+        self.worst_device = ""
+        self.cores_derived = []
+        self.spare_cpu = self.previous_cpu
         self.previous_cpu = self.cpu
         self.cpu = None
-        self.previous_devices = self.devices
-        self.devices = []
+        self.devices, self.previous_devices = self.previous_devices, self.devices
         self.previous_timestamp = self.timestamp
         self.timestamp = -1
-        self.previous_interfaces = self.interfaces
-        self.interfaces = []
+        self.interfaces, self.previous_interfaces = self.previous_interfaces, self.interfaces
+        self.cores, self.previous_cores = self.previous_cores, self.cores
         self.previous_connection_active = self.connection_active
         self.connection_active = -1
         self.previous_connection_failed = self.connection_failed
         self.connection_failed = -1
+        self.gc_count = 0
+        self.gc_total = 0
+        self.gc_max = 0
 
     def percent_cpu(self):
         if self.cpu is None or self.previous_cpu is None:
@@ -93,51 +252,194 @@ class Host:
         total_delta = self.cpu.all() - self.previous_cpu.all()
         return 1 - (total_delta - getattr(self.cpu, attr) + getattr(self.previous_cpu, attr)) / total_delta
 
-    def all_stat(self, key, stat):
-        if len(getattr(self, key)) == 0 or len(getattr(self, "previous_"+key)) == 0:
-            return -1
-        value = 0
-        for item in getattr(self, key):
-            value = value + getattr(item, stat)
-        for item in getattr(self, "previous_"+key):
-            value = value - getattr(item, stat)
-        return value
-
-    def all_devices_stat(self, stat):
-        return self.all_stat("devices", stat)
-
-    def all_devices_stat_ms(self, stat):
-        return self.all_devices_stat(stat) / (self.timestamp - self.previous_timestamp)
-
-    def all_r_await(self):
-        if self.all_devices_stat('read_completed') == 0:
-            return 0
-        return self.all_devices_stat('time_spent_reading') / self.all_devices_stat('read_completed') / (self.timestamp - self.previous_timestamp) * 1000
-
-    def all_w_await(self):
-        if self.all_devices_stat('write_completed') == 0:
-            return 0
-        return self.all_devices_stat('time_spent_writing') / self.all_devices_stat('write_completed') / (self.timestamp - self.previous_timestamp) * 1000
-
-    def all_interfaces_stat(self, stat):
-        return self.all_stat("interfaces", stat)
-
-
-class Cpu:
-    regexp= ""
-    for i in range(0, 7):
-        regexp = regexp + "\s{1,20}(\d{1,20})"
-    regexp_cpu_line = re.compile(r'^cpu\s{1,10}'+regexp+'')
-
-    def __init__(self, r):
-        self.user = float(r.group(1))
-        self.nice = float(r.group(2))
-        self.system = float(r.group(3))
-        self.idle = float(r.group(3))
-        self.iowait = float(r.group(4))
-        self.irq = float(r.group(5))
-        self.softirq = float(r.group(6))
-        self.steal = float(r.group(7))
+    def update_cpu(self, fields):
+        cpu = self.spare_cpu if self.spare_cpu is not None else Cpu()
+        cpu.update(fields)
+        self.cpu = cpu
+
+    def update_item(self, items, cls, name, fields):
+        #Update the object of the measure before the previous one in place, a new object only for a new name.
+        #Returns True if the object is new.
+        item = items.get(name)
+        created = item is None
+        if created:
+            item = cls()
+            items[name] = item
+        item.update(name, fields)
+        item.generation = self.generation
+        return created
+
+    def remove_missing(self, items, count):
+        #Objects not updated by the current measure (removed device or interface), count is the number of updated ones.
+        #Returns True if some were removed.
+        if len(items) == count:
+            return False
+        for name in [name for name, item in items.items() if item.generation != self.generation]:
+            del items[name]
+        return True
+
+    def find_excluded(self):
+        #Devices not counted in the totals: the partitions (sda1, nvme0n1p1...) of a disk also listed in /proc/diskstats
+        #would count its I/O twice, and devices with a - in their name (dm-0...) were never counted, keep it that way.
+        #The virtual devices (loop, ram...) are never selected by default nor reported as the busiest device.
+        for device in self.devices.itervalues():
+            device.excluded = not device.name.isalnum() or parent_disk(device.name) in self.devices
+            device.virtual = device.name.startswith(VIRTUAL_DEVICES)
+
+    def select_devices(self):
+        #Devices of the per device view and of the %util column, with the data directories they contain:
+        #matching --devices, or backing --data_dirs, or all the devices counted in the totals except the virtual ones
+        roles = {}
+        for line in self.dirs.split("\n"):
+            if " " in line:
+                dev, path = line.split(" ", 1)
+                dev = int(dev, 16)
+                roles.setdefault((os.major(dev), os.minor(dev)), []).append(os.path.basename(path.rstrip("/")))
+        devices = [(device.name, ",".join(roles.get((device.major, device.minor), []))) for device in self.devices.itervalues()]
+        if len(device_patterns) > 0:
+            selected = [(name, role) for name, role in devices if any([fnmatch.fnmatchcase(name, pattern) for pattern in device_patterns])]
+        elif any([role != "" for name, role in devices]):
+            selected = [(name, role) for name, role in devices if role != ""]
+        else:
+            selected = [(name, role) for name, role in devices if not self.devices[name].excluded and not self.devices[name].virtual]
+        self.selected_devices = sorted(selected)
+
+    def device_deltas(self):
+        #Deltas of the DEVICE_GETTER counters of each device, by name, computed once per measure for the totals and the per
+        #device view. A device added or removed between the measures is ignored, and so is a device with any counter going
+        #backward: reset (reboot, driver reload) or wrap of a 32 bits counter.
+        deltas = {}
+        previous_devices = self.previous_devices
+        for name, device in self.devices.iteritems():
+            previous = previous_devices.get(name)
+            if previous is None:
+                continue
+            delta = map(operator.sub, DEVICE_GETTER(device), DEVICE_GETTER(previous))
+            if min(delta) >= 0:
+                deltas[name] = delta
+        return deltas
+
+    def device_totals(self, deltas):
+        #Deltas of DEVICE_STATS summed over the devices counted in the totals. NaN without any device.
+        devices = self.devices
+        counted = [delta for name, delta in deltas.iteritems() if not devices[name].excluded]
+        if len(counted) == 0:
+            return [float("nan")] * len(DEVICE_STATS)
+        return map(sum, zip(*counted))[:len(DEVICE_STATS)]
+
+    def device_values(self, elapsed, deltas):
+        #DEVICE_COLUMNS of each selected device present in both measures
+        results = []
+        for name, role in self.selected_devices:
+            delta = deltas.get(name)
+            if delta is None:
+                continue
+            read_completed, sectors_read, time_spent_reading, write_completed, sectors_written, time_spent_writing, weighted_io_time, io_time = delta
+            results.append((name, role, (read_completed / elapsed * 1000, write_completed / elapsed * 1000,
+                                         sectors_read * 512 / elapsed / 1000, sectors_written * 512 / elapsed / 1000,
+                                         0 if read_completed == 0 else time_spent_reading / read_completed,
+                                         0 if write_completed == 0 else time_spent_writing / write_completed,
+                                         weighted_io_time / elapsed, min(100, io_time / elapsed * 100))))
+        return results
+
+    def all_deltas(self, key, stats):
+        #Deltas of several counters summed over the interfaces (or devices), matched by name between the 2 measures.
+        #An interface added or removed between the measures is ignored, and so is an interface with any counter going backward:
+        #reset (reboot, driver reload) or wrap of a 32 bits counter. NaN without any interface.
+        items = getattr(self, key)
+        previous_items = getattr(self, "previous_"+key)
+        getter = operator.attrgetter(*stats)
+        current = []
+        previous = []
+        for name, item in items.iteritems():
+            previous_item = previous_items.get(name)
+            if previous_item is None:
+                continue
+            values = getter(item)
+            previous_values = getter(previous_item)
+            if any(map(operator.lt, values, previous_values)):
+                continue
+            current.append(values)
+            previous.append(previous_values)
+        if len(current) == 0:
+            return [float("nan")] * len(stats)
+        return [delta if delta >= 0 else float("nan") for delta in map(operator.sub, map(sum, zip(*current)), map(sum, zip(*previous)))]
+
+    def core_values(self):
+        #CORE_COLUMNS of each core present in both measures (fraction of the time of the core, 0 -> 1)
+        results = []
+        previous_cores = self.previous_cores
+        for name, core in self.cores.iteritems():
+            previous = previous_cores.get(name)
+            if previous is None:
+                continue
+            user = core.user - previous.user
+            system = core.system - previous.system
+            idle = core.idle - previous.idle
+            iowait = core.iowait - previous.iowait
+            irq = core.irq - previous.irq
+            softirq = core.softirq - previous.softirq
+            steal = core.steal - previous.steal
+            total = user + core.nice - previous.nice + system + idle + iowait + irq + softirq + steal
+            if total <= 0:
+                continue
+            results.append((name, ((total - idle - iowait) / total, user / total, system / total, iowait / total, irq / total, softirq / total, steal / total)))
+        return results
+
+    def derived_values(self):
+        #Columns of CLUSTER_COLUMNS, NaN for the unknown log counts. Computed once per measure (see updateHost).
+        elapsed = float(self.timestamp - self.previous_timestamp)
+        #Busiest core, and number of cores busier than --core_threshold
+        self.cores_derived = self.core_values()
+        busy = [values[0] for name, values in self.cores_derived]
+        max_core = max(busy) if len(busy) > 0 else float("nan")
+        hot_cores = len([value for value in busy if value > args.core_threshold]) if len(busy) > 0 else float("nan")
+        deltas = self.device_deltas()
+        read_completed, sectors_read, time_spent_reading, write_completed, sectors_written, time_spent_writing, weighted_io_time = \
+            self.device_totals(deltas)
+        rx_bytes, rx_ok, rx_error, rx_dropped, rx_overrun, tx_bytes, tx_ok, tx_error, tx_dropped, tx_overrun = self.all_deltas("interfaces", INTERFACE_STATS)
+        #Busiest of the selected devices, except the virtual ones
+        self.devices_derived = self.device_values(elapsed, deltas)
+        physical = [device for device in self.devices_derived if not self.devices[device[0]].virtual]
+        worst = max(physical, key=lambda device: device[2][-1]) if len(physical) > 0 else None
+        self.worst_device = "" if worst is None else worst[0]
+        r_await = 0 if read_completed == 0 else time_spent_reading / read_completed
+        w_await = 0 if write_completed == 0 else time_spent_writing / write_completed
+        connection_active = self.connection_active - self.previous_connection_active
+        connection_failed = self.connection_failed - self.previous_connection_failed
+        return (self.percent_cpu(), self.cpu_stat('user'), self.cpu_stat('nice'), max_core, hot_cores, weighted_io_time / elapsed,
+                read_completed / elapsed * 1000, sectors_read / elapsed * 1000, r_await,
+                write_completed / elapsed * 1000, sectors_written / elapsed * 1000, w_await,
+                rx_bytes / elapsed * 1000, rx_ok, rx_error + rx_dropped + rx_overrun,
+                tx_bytes / elapsed * 1000, tx_ok, tx_error + tx_dropped + tx_overrun,
+                float("nan") if connection_active < 0 else connection_active, float("nan") if connection_failed < 0 else connection_failed,
+                self.gc_count, self.gc_total, self.gc_max,
+                float("nan") if self.warn_count < 0 else self.warn_count, float("nan") if self.error_count < 0 else self.error_count,
+                float("nan") if worst is None else worst[2][-1])
+
+    def publish(self):
+        #Replace the snapshot of the host by the last measure. The history summary is only computed when it's displayed or dumped.
+        history_summary = None
+        if self.history is not None and self.history.count > 0 and (args.view == "history" or args.dump_history):
+            history_summary = tuple([tuple(self.history.summary(metric)) for metric in HISTORY_METRICS])
+        self.snapshot = Snapshot(self.name, self.timestamp, self.derived, self.worst_device, tuple(self.devices_derived), tuple(self.cores_derived), history_summary)
+
+    def complete(self):
+        #The 2 last measures are complete, the derived metrics can be computed. Not after a reboot (cpu counters reset).
+        return self.cpu is not None and self.previous_cpu is not None and 0 < self.previous_timestamp < self.timestamp \
+            and self.cpu.all() > self.previous_cpu.all()
+
+
+class Cpu(object):
+    __slots__ = ("user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal")
+
+    def update(self, fields):
+        #/proc/stat cpu line, split: cpu user nice system idle iowait irq softirq steal guest guest_nice
+        if len(fields) > 8:
+            self.user, self.nice, self.system, self.idle, self.iowait, self.irq, self.softirq, self.steal = map(float, fields[1:9])
+        else:
+            self.user, self.nice, self.system, self.idle, self.iowait, self.irq, self.softirq = map(float, fields[1:8])
+            self.steal = 0
 
     def all(self):
         return self.all_non_idle() + self.all_idle()
@@ -148,13 +450,27 @@ class Cpu:
     def all_non_idle(self):
         return self.user + self.nice + self.system + self.irq + self.softirq + self.steal
 
-class Device:
-    regexp= ""
-    for i in range(0, 11):
-        regexp = regexp + "\s{1,20}(\d{1,20})"
-    regexp_device_line = re.compile(r'^\s{1,10}\d{1,10}\s{1,10}\d{1,10}\s([0-9a-zA-Z]{1,20})'+regexp+'.*')
+class Core(Cpu):
+    #cpuN line of a core, updated in place like the devices (see Host.update_item)
+    __slots__ = ("generation",)
+
+    def update(self, name, fields):
+        Cpu.update(self, fields)
+
+def parent_disk(name):
+    #sda1 -> sda, nvme0n1p2 -> nvme0n1, mmcblk0p1 -> mmcblk0. None if the name doesn't end with a number.
+    base = name.rstrip("0123456789")
+    if base == name:
+        return None
+    if base.endswith("p") and base[-2:-1].isdigit():
+        return base[:-1]
+    return base
 
-    def __init__(self, r):
+class Device(object):
+    __slots__ = ("generation", "excluded", "virtual", "major", "minor", "name", "read_completed", "read_merged", "sectors_read", "time_spent_reading", "write_completed", "write_merged",
+                 "sectors_written", "time_spent_writing", "io_count", "io_time", "weighted_io_time")
+
+    def update(self, name, fields):
         #/proc/diskstats as following:
         # 8      16 sdb 828 20 6784 24 0 0 0 0 0 24 24
         # Field  1 -- # of reads completed
@@ -183,112 +499,148 @@ class Device:
         #   This field is incremented at each I/O start, I/O completion, I/O merge, or read of these stats by the number of I/Os in progress (field 9)
         #   times the number of milliseconds spent doing I/O since the last update of this field.  This can provide an easy measure of both
         #   I/O completion time and the backlog that may be accumulating.
-        self.name = r.group(1) # 3
-        self.read_completed = float(r.group(2)) # 4
-        self.read_merged = float(r.group(3)) # 5
-        self.sectors_read = float(r.group(4)) # 6
-        self.time_spent_reading = float(r.group(5)) # 7
-        self.write_completed = float(r.group(6)) # 8
-        self.write_merged = float(r.group(7)) # 9
-        self.sectors_written = float(r.group(8)) # 10
-        self.time_spent_writing = float(r.group(9)) # 11
-        self.io_count = float(r.group(10)) # 12
-        self.io_time = float(r.group(11)) # 13
-        self.weighted_io_time = float(r.group(12)) # 14
-
-class Interface:
-    regexp= ""
-    for i in range(0, 8):
-        regexp = regexp + "\s{1,20}(\d{1,20})"
-    regexp_interface_line = re.compile(r'^(\w{1,20})\s{1,20}(\d{1,20})(?:\s{1,20}\d{1,20})?'+regexp+'\s{1,20}(\w{1,20})$')
-    regexp_connection_active = re.compile(r'(\d{1,20}) active connections opening')
-    regexp_connection_failed= re.compile(r'(\d{1,20}) failed connection attempts')
-
-    def __init__(self, r):
-        self.name = r.group(1)
-        self.mtu = float(r.group(2))
-        self.rx_ok = float(r.group(3))
-        self.rx_error = float(r.group(4))
-        self.rx_dropped = float(r.group(5))
-        self.rx_overrun = float(r.group(6))
-        self.tx_ok = float(r.group(7))
-        self.tx_error = float(r.group(8))
-        self.tx_dropped = float(r.group(9))
-        self.tx_overrun = float(r.group(10))
-        self.flag = r.group(11)
+        #fields is the split line: major, minor, name, then the fields above (and more on recent kernels)
+        self.major = int(fields[0]) # 1
+        self.minor = int(fields[1]) # 2
+        self.name = name # 3
+        self.read_completed = float(fields[3]) # 4
+        self.read_merged = float(fields[4]) # 5
+        self.sectors_read = float(fields[5]) # 6
+        self.time_spent_reading = float(fields[6]) # 7
+        self.write_completed = float(fields[7]) # 8
+        self.write_merged = float(fields[8]) # 9
+        self.sectors_written = float(fields[9]) # 10
+        self.time_spent_writing = float(fields[10]) # 11
+        self.io_count = float(fields[11]) # 12
+        self.io_time = float(fields[12]) # 13
+        self.weighted_io_time = float(fields[13]) # 14
+
+class Interface(object):
+    __slots__ = ("generation", "name", "rx_bytes", "rx_ok", "rx_error", "rx_dropped", "rx_overrun", "tx_bytes", "tx_ok", "tx_error", "tx_dropped", "tx_overrun")
+
+    def update(self, name, fields):
+        #/proc/net/dev as following:
+        #  eth0: 1234 10 0 0 0 0 0 0 5678 12 0 0 0 0 0 0
+        #  name: rx bytes packets errs drop fifo frame compressed multicast | tx bytes packets errs drop fifo colls carrier compressed
+        #fifo is the overrun counter reported by netstat -i
+        #fields is the split line after "name:"
+        self.name = name
+        self.rx_bytes = float(fields[0])
+        self.rx_ok = float(fields[1])
+        self.rx_error = float(fields[2])
+        self.rx_dropped = float(fields[3])
+        self.rx_overrun = float(fields[4])
+        self.tx_bytes = float(fields[8])
+        self.tx_ok = float(fields[9])
+        self.tx_error = float(fields[10])
+        self.tx_dropped = float(fields[11])
+        self.tx_overrun = float(fields[12])
 
 class HostObserver:
     def __init__(self):
         self.hosts = {}
         for host in args.hosts:
             self.hosts[host] = Host(host)
+        #Number of measures received and of connections started or stopped, the OpenMetrics text is rebuilt when they change
+        self.measures = 0
+        self.state_changes = 0
 
-    regexp_stop_line = re.compile(r'threads were stopped: (\d{1,10},\d{1,10}) seconds')
+    gc_stop_prefix = "threads were stopped: "
 
-    def updateHost(self, host_name, lines):
+    def updateHost(self, host_name, sections):
+        #sections: content of each section of a frame (see read_frames)
+        #Only called from the collection thread: the host is parsed without lock, the display and the csv dump read the
+        #snapshot published at the end.
         host = self.hosts[host_name]
-        host.mutex.acquire()
         try:
             host.reset()
-            in_netstat = False
-            #Get the date first. Can't do anything if we don't get the date (might happen if we get errors in the commands).
-            for line in lines:
-                if line.startswith("__DATE__"):
-                    host.timestamp = int(line[len("__DATE__"):-1])
-                    date_found = True
-            if not date_found:
+            #Can't do anything if we don't get the date (might happen if we get errors in the commands).
+            if sections.get("date", "") == "":
                 host.timestamp = -2
-            else:
-                for line in lines:
-                    if line.startswith("__ERROR__"):
-                        host.previous_error_count = host.error_count
-                        host.error_count = int(line[len("__ERROR__"):-1])
-                    elif line.startswith("__WARN__"):
-                        host.previous_warn_count = host.warn_count
-                        host.warn_count = int(line[len("__WARN__"):-1])
-                    #NETSTAT -i
-                    elif(line.startswith("__NETSTAT_START__")):
-                        in_netstat = True
-                    elif(line.startswith("__NETSTAT_END__")):
-                        in_netstat = False
-                    elif in_netstat:
-                        r = Interface.regexp_connection_active.search(line)
-                        if r is not None:
-                            host.connection_active = int(r.group(1))
-                        r = Interface.regexp_connection_failed.search(line)
-                        if r is not None:
-                            host.connection_failed = int(r.group(1))
-
-                        r = Interface.regexp_interface_line.search(line)
-                        if r is not None:
-                            interface = Interface(r)
-                            if not args.exclude_lo or interface.name != "lo":
-                                host.interfaces.append(interface)
+                cluster.clear(host_name)
+                log(host_name+": ERROR DATE NOT FOUND")
+                return
+            host.timestamp = int(sections["date"])
+            #Only sent every log_grep_freq measures
+            if sections["log"] != "":
+                errors, warns = sections["log"].split(" ")
+                host.error_count = int(errors)
+                host.warn_count = int(warns)
+            #/proc/net/dev, skip the 2 header lines
+            count = 0
+            for line in sections["netdev"].split("\n"):
+                end = line.find(":")
+                if end != -1:
+                    name = line[:end].strip()
+                    if not args.exclude_lo or name != "lo":
+                        host.update_item(host.interfaces, Interface, name, line[end+1:].split())
+                        count += 1
+            host.remove_missing(host.interfaces, count)
+            #/proc/net/snmp: Tcp: header line with the counter names, then Tcp: line with the values.
+            #ActiveOpens and AttemptFails are the "active connections opening" and "failed connection attempts" of netstat -s
+            snmp = sections["snmp"].split("\n")
+            if len(snmp) >= 2:
+                snmp_header = snmp[0].split()
+                values = snmp[1].split()
+                host.connection_active = int(values[snmp_header.index("ActiveOpens")])
+                host.connection_failed = int(values[snmp_header.index("AttemptFails")])
+            #jvm stat, one line per stop the world pause (seconds, with a , or a . depending on the locale)
+            for line in sections["gc"].split("\n"):
+                if line.startswith(HostObserver.gc_stop_prefix):
+                    pause = float(line[len(HostObserver.gc_stop_prefix):].replace(",", "."))*1000
+                    host.gc_count += 1
+                    host.gc_total += pause
+                    host.gc_max = max(host.gc_max, pause)
+            #diskstat: one device per line
+            count = 0
+            changed = False
+            for line in sections["diskstats"].split("\n"):
+                fields = line.split()
+                if len(fields) >= 14:
+                    changed = host.update_item(host.devices, Device, fields[2], fields) or changed
+                    count += 1
+            if host.remove_missing(host.devices, count) or changed:
+                changed = True
+                host.find_excluded()
+            #devices of the data directories, only sent by the recent shell loops and agents
+            dirs = sections.get("dirs", "")
+            if changed or dirs != host.dirs:
+                host.dirs = dirs
+                host.select_devices()
+            #cpu stats: the aggregated cpu line, then one cpuN line per core. The intr (thousands of numbers) and softirq
+            #lines that follow are never read.
+            count = 0
+            for line in sections["stat"].split("\n"):
+                if not line.startswith("cpu"):
+                    break
+                fields = line.split()
+                if len(fields) > 7:
+                    if fields[0] == "cpu":
+                        host.update_cpu(fields)
                     else:
-                        #jvm stat
-                        r = HostObserver.regexp_stop_line.search(line)
-                        if r is not None:
-                            host.jvm_stop = float(r.group(1).replace(",", "."))*1000
-                        else:
-                            #diskstat
-                            r = Device.regexp_device_line.search(line)
-                            if r is not None:
-                                host.devices.append(Device(r))
-                            else:
-                                #cpu stats
-                                r = Cpu.regexp_cpu_line.search(line)
-                                if r is not None:
-                                    host.cpu = Cpu(r)
-            if not date_found:
-                print "ERROR DATE NOT FOUND"
-                for line in lines:
-                    print line
+                        host.update_item(host.cores, Core, fields[0], fields)
+                        count += 1
+            #Cores put offline
+            host.remove_missing(host.cores, count)
+            if host.complete():
+                host.derived = host.derived_values()
+                cluster.update(host_name, host.derived)
+                if host.history is not None:
+                    host.history.append(host.timestamp, [host.derived[CLUSTER_INDEX[metric]] for metric in HISTORY_METRICS])
+            else:
+                cluster.clear(host_name)
         finally:
-            host.mutex.release()
+            host.publish()
+            self.measures += 1
+            updated.set()
+            if dump is not None and host.snapshot.derived is not None:
+                dump.add(host.snapshot)
 
 
 def format_int(val, warn, error, align):
-    if val>100000:
+    if val>100000000:
+        txt = ("%.0f" %(val/1000000))+"M"
+    elif val>100000:
         txt = ("%.0f" %(val/1000))+"k"
     elif val>1000:
         txt = ("%.2f" %(val/1000))+"k"
@@ -317,6 +669,459 @@ def colorize(val, txt, warn, error, align):
         return BColors.WARNING+txt+BColors.ENDC
     return txt
 
+def cut_lines(lines, count):
+    #At most count lines, the last one counts the hidden lines
+    if len(lines) <= count:
+        return lines
+    if count <= 0:
+        return []
+    return lines[:count - 1] + ["... "+str(len(lines) - count + 1)+" more lines hidden, resize the terminal or use --hosts/--view"]
+
+class Screen:
+    #Differential renderer: the previous frame is kept as cells (character, color) and only the cells that changed are
+    #written, with cursor positioning, in a single write per frame. The terminal is cleared on the first frame and when
+    #it is resized only, and the lines are cut to its width (no wrapping, so that the positions stay right) and to its height
+    #(with a marker of the hidden lines).
+    #When the output isn't a terminal, the frames are printed one after the other.
+    color_code = re.compile("(\033\\[[0-9;]*m)")
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.tty = out.isatty()
+        self.rows = []
+        self.size = None
+
+    def terminal_size(self):
+        try:
+            return struct.unpack("hh", fcntl.ioctl(self.out.fileno(), termios.TIOCGWINSZ, "1234"))
+        except (IOError, OSError, struct.error):
+            return 10000, 10000
+
+    def cells(self, line, width):
+        cells = []
+        color = ""
+        for part in Screen.color_code.split(line):
+            if part.startswith("\033["):
+                color = "" if part == BColors.ENDC else part
+            elif part != "":
+                cells.extend([(char, color) for char in part[:width - len(cells)]])
+        return cells
+
+    def draw(self, lines, footer=()):
+        if not self.tty:
+            self.out.write("\n".join(list(lines) + list(footer))+"\n\n")
+            self.out.flush()
+            return
+        size = self.terminal_size()
+        output = []
+        if size != self.size:
+            output.append("\033[2J")
+            self.rows = []
+            self.size = size
+        height, width = size
+        #The lines under the terminal are replaced by a marker, the footer (messages) is always displayed
+        footer = list(footer)[-(height - 2):] if height > 2 else []
+        lines = cut_lines(lines, height - 1 - len(footer)) + footer
+        rows = [self.cells(line, width) for line in lines]
+        for idx, row in enumerate(rows):
+            previous = self.rows[idx] if idx < len(self.rows) else []
+            if row == previous:
+                continue
+            #Runs of changed cells
+            col = 0
+            while col < len(row):
+                if col < len(previous) and row[col] == previous[col]:
+                    col += 1
+                    continue
+                output.append("\033[%d;%dH" % (idx + 1, col + 1))
+                color = ""
+                while col < len(row) and (col >= len(previous) or row[col] != previous[col]):
+                    char, cell_color = row[col]
+                    if cell_color != color:
+                        output.append(BColors.ENDC+cell_color)
+                        color = cell_color
+                    output.append(char)
+                    col += 1
+                if color != "":
+                    output.append(BColors.ENDC)
+            if len(previous) > len(row):
+                output.append("\033[%d;%dH\033[K" % (idx + 1, len(row) + 1))
+        if len(self.rows) > len(rows):
+            output.append("\033[%d;1H\033[J" % (len(rows) + 1))
+        output.append("\033[%d;1H" % (len(rows) + 1))
+        self.rows = rows
+        self.out.write("".join(output))
+        self.out.flush()
+
+screen = Screen()
+#Messages of the collection (connections, errors) displayed under the hosts once the rendering has started
+messages = collections.deque(maxlen=5)
+
+def log(message):
+    if rendering.is_set():
+        messages.append(datetime.datetime.now().strftime('%H:%M:%S')+" "+message)
+    else:
+        print message
+rendering = threading.Event()
+
+#Columns of the host table: name, separator, format, warn, error, width, cluster aggregation (sum or avg) of the summary rows
+CLUSTER_COLUMNS = [("cpu", "", format_float, 0.7, 0.9, 7, "avg"), ("cpu_user", "", format_float, 0.7, 0.9, 7, "avg"), ("cpu_nice", "", format_float, 0.7, 0.9, 7, "avg"),
+                   ("cpu_max_core", "", format_float, 0.7, 0.9, 7, "avg"), ("hot_cores", "", format_int, 0, 1, 5, "sum"),
+                   ("avgqu-sz", "| ", format_float, 10, 100, 10, "avg"),
+                   ("r/s", "| ", format_float, 500, 5000, 10, "sum"), ("sector_r", "", format_int, 1000, 10000, 10, "sum"), ("r_await", "", format_float, 30, 100, 10, "avg"),
+                   ("w/s", "| ", format_float, 500, 5000, 10, "sum"), ("sector_w", "", format_int, 1000, 10000, 10, "sum"), ("w_await", "", format_float, 30, 100, 10, "avg"),
+                   ("rx_bytes/s", "| ", format_int, 50000000, 100000000, 9, "sum"), ("rx_ok", "", format_int, 10000, 100000, 7, "sum"), ("rx_ko", "", format_int, 0, 10, 7, "sum"),
+                   ("tx_bytes/s", "", format_int, 50000000, 100000000, 9, "sum"), ("tx_ok", "", format_int, 10000, 100000, 7, "sum"), ("tx_ko", "", format_int, 0, 10, 7, "sum"),
+                   ("connection_active", "", format_int, 50, 100, 10, "sum"), ("connection_fail", "", format_int, 0, 10, 10, "sum"),
+                   ("gc_count", "| ", format_int, 1, 5, 5, "sum"), ("gc_total_ms", "", format_float, 100, 500, 8, "avg"), ("gc_max_ms", "", format_float, 100, 500, 8, "avg"),
+                   ("warning", "| ", format_int, 0, 1, 10, "sum"), ("error", "", format_int, 0, 0, 10, "sum"),
+                   ("disk_util", "| ", format_float, 60, 90, 7, "avg")]
+CLUSTER_SUMMARY_ROWS = ("total/avg", "min", "median", "p95", "max")
+CLUSTER_INDEX = dict((column[0], idx) for idx, column in enumerate(CLUSTER_COLUMNS))
+
+class ClusterMatrix:
+    #Derived metrics of the last measure of all the hosts, one row per host and one column per CLUSTER_COLUMNS.
+    #Updated at each measure of a host, the summary rows of the whole cluster are computed column by column: with numpy
+    #in a few vectorized operations, with sorted python lists when numpy isn't installed.
+    #Hosts without a complete measure (and unknown values) are NaN and ignored.
+    def __init__(self, hosts):
+        self.hosts = list(hosts)
+        self.index = dict((host, idx) for idx, host in enumerate(self.hosts))
+        self.sum_columns = [column[6] == "sum" for column in CLUSTER_COLUMNS]
+        #Minimum deviation taken into account for the outliers, so that a flat column (eg: no error on any host) doesn't
+        #make the first small change an outlier
+        self.min_deviation = [max(column[3] / 10.0, 0.001) for column in CLUSTER_COLUMNS]
+        if numpy is not None:
+            self.rows = numpy.full((len(self.hosts), len(CLUSTER_COLUMNS)), numpy.nan)
+        else:
+            self.rows = [None] * len(self.hosts)
+
+    def update(self, host, values):
+        if numpy is not None:
+            self.rows[self.index[host]] = values
+        else:
+            self.rows[self.index[host]] = list(values)
+
+    def clear(self, host):
+        if numpy is not None:
+            self.rows[self.index[host]] = numpy.nan
+        else:
+            self.rows[self.index[host]] = None
+
+    def summary(self):
+        #Rows of CLUSTER_SUMMARY_ROWS (one value per column), and the outliers: [(score, host, column index, value)] sorted
+        #by score. The score is the distance to the median of the cluster in robust standard deviations (1.4826 * MAD).
+        if numpy is not None:
+            return self.summary_numpy()
+        return self.summary_python()
+
+    def summary_numpy(self):
+        rows = self.rows.copy()
+        valid = ~numpy.isnan(rows)
+        counts = valid.sum(axis=0)
+        with warnings.catch_warnings():
+            #Columns without any value are NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            totals = numpy.where(self.sum_columns, numpy.nansum(rows, axis=0), numpy.nanmean(rows, axis=0))
+            totals[counts == 0] = numpy.nan
+            percentiles = numpy.nanpercentile(rows, [0, 50, 95, 100], axis=0)
+            deviation = numpy.maximum(1.4826 * numpy.nanmedian(numpy.abs(rows - percentiles[1]), axis=0), self.min_deviation)
+            scores = numpy.nan_to_num((rows - percentiles[1]) / deviation)
+        worst = scores.argmax(axis=1)
+        host_scores = scores[numpy.arange(len(self.hosts)), worst]
+        outliers = [(host_scores[idx], self.hosts[idx], worst[idx], rows[idx, worst[idx]]) for idx in numpy.argsort(-host_scores) if host_scores[idx] > 0]
+        return [totals] + list(percentiles), outliers
+
+    def summary_python(self):
+        rows = [(self.hosts[idx], row) for idx, row in enumerate(self.rows) if row is not None]
+        summary = [[float("nan")] * len(CLUSTER_COLUMNS) for name in CLUSTER_SUMMARY_ROWS]
+        medians = [float("nan")] * len(CLUSTER_COLUMNS)
+        deviations = list(self.min_deviation)
+        for col in range(len(CLUSTER_COLUMNS)):
+            values = sorted([row[col] for host, row in rows if row[col] == row[col]])
+            if len(values) == 0:
+                continue
+            summary[0][col] = sum(values) if self.sum_columns[col] else sum(values) / len(values)
+            for idx, percentile in enumerate((0, 50, 95, 100)):
+                #Linear interpolation between the closest ranks, like numpy
+                position = percentile / 100.0 * (len(values) - 1)
+                low = int(position)
+                high = min(low + 1, len(values) - 1)
+                summary[idx+1][col] = values[low] + (values[high] - values[low]) * (position - low)
+            medians[col] = summary[2][col]
+            differences = sorted([abs(value - medians[col]) for value in values])
+            deviations[col] = max(1.4826 * differences[len(differences) // 2], self.min_deviation[col])
+        outliers = []
+        for host, row in rows:
+            scores = [((row[col] - medians[col]) / deviations[col], col) for col in range(len(CLUSTER_COLUMNS)) if row[col] == row[col]]
+            if len(scores) > 0 and max(scores)[0] > 0:
+                score, col = max(scores)
+                outliers.append((score, host, col, row[col]))
+        outliers.sort(reverse=True)
+        return summary, outliers
+
+def format_values(values, colors, device=""):
+    #Columns of the host and summary rows. The thresholds are per host: the total row isn't colored.
+    #device: name of the busiest device, displayed after its %util.
+    report = ""
+    for (name, separator, formatter, warn, error, width, aggregation), value in zip(CLUSTER_COLUMNS, values):
+        if value != value:
+            report += separator+"-".ljust(width, " ")
+        elif colors:
+            report += separator+formatter(value, warn, error, width)
+        else:
+            report += separator+formatter(value, float("inf"), float("inf"), width)
+    return report+device
+
+#Format of the CLUSTER_COLUMNS in the csv file
+CSV_FORMATS = ("%.3f", "%.3f", "%.3f", "%.3f", "%d", "%.3f", "%.3f", "%d", "%.3f", "%d", "%d", "%.3f", "%d", "%d", "%d", "%d", "%d", "%d", "%d", "%d", "%d", "%.3f", "%.3f", "%d", "%d", "%.3f")
+CSV_HEADER = ["host","timestamp","cpu-avg","cpu-user","cpu-nice","cpu-max-core","cpu-hot-cores","avgqu-sz","r/s","sector_r","r_await","w/s","sector_w","w_await","rx_bytes/s","rx_ok","rx_ko","tx_bytes/s","tx_ok","tx_ko","connection_active","connection_fail","gc_count","gc_total_ms","gc_max_ms","warning","error","disk_util","disk_util_device"]
+
+def csv_row(host):
+    #Row of a snapshot, the unknown values are written as -1
+    row = [host.name, host.timestamp] + [-1 if value != value else format % value for format, value in zip(CSV_FORMATS, host.derived)] + [host.worst_device]
+    if args.dump_history:
+        #Same number of columns as the header when the history isn't computed yet (or disabled by --history=0)
+        if host.history_summary is None:
+            row += [-1] * (len(HISTORY_METRICS) * len(HISTORY_COLUMNS))
+        else:
+            row += [-1 if value != value else "%.3f" % value for summary in host.history_summary for value in summary]
+    return row
+
+class CsvWriter:
+    def __init__(self, path, header):
+        self.path = path
+        self.file = open(path, 'wb', 1048576)
+        self.writer = csv.writer(self.file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self.writer.writerow(header)
+
+    def write(self, snapshots):
+        self.writer.writerows([csv_row(snapshot) for snapshot in snapshots])
+
+    def flush(self):
+        self.file.flush()
+
+class RecordingWriter:
+    #Binary recording (see monitoring_recording.py): the derived metrics, then the history summary (NaN when not computed yet)
+    def __init__(self, path, header):
+        self.path = path
+        self.history_size = len(HISTORY_METRICS) * len(HISTORY_COLUMNS) if args.dump_history else 0
+        columns = [column for column in header[2:] if column != "disk_util_device"]
+        formats = list(CSV_FORMATS) + ["%.3f"] * self.history_size
+        self.recording = monitoring_recording.RecordingWriter(path, args.hosts, columns, formats)
+
+    def write(self, snapshots):
+        for host in snapshots:
+            values = host.derived
+            if self.history_size > 0:
+                if host.history_summary is None:
+                    values += (float("nan"),) * self.history_size
+                else:
+                    values += tuple([value for summary in host.history_summary for value in summary])
+            self.recording.append(host.name, host.timestamp, values, host.worst_device)
+
+    def flush(self):
+        self.recording.flush()
+
+class Dump:
+    #Write the dump from a single thread: the collection thread queues the snapshot of each new measure (one row per
+    #host per sample, whatever the refresh rate of the display), the writer (CsvWriter or RecordingWriter) writes them by
+    #batches and is flushed every flush_interval sec, so the file is opened once for the whole capture.
+    #Also used to record the data received from the hosts (RawWriter).
+    #The queue is bounded: if the disk can't keep up, the rows are dropped (and counted) rather than slowing the collection.
+    #A write error (disk full...) stops the dump, the collection and the display go on.
+    def __init__(self, writer, flush_interval=5, max_pending=100000):
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(max_pending)
+        self.dropped = 0
+        self.failed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, snapshot):
+        if self.failed:
+            return
+        try:
+            self.queue.put_nowait(snapshot)
+        except Queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log("dump: "+str(self.dropped)+" row(s) dropped, "+self.writer.path+" is too slow")
+
+    def write_pending(self, timeout):
+        #Wait for a first row (at most timeout sec), then take all the rows already queued.
+        #Returns False once the None queued by close is reached.
+        try:
+            snapshots = [self.queue.get(True, timeout)]
+        except Queue.Empty:
+            return True
+        try:
+            while snapshots[-1] is not None:
+                snapshots.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        self.writer.write([snapshot for snapshot in snapshots if snapshot is not None])
+        return snapshots[-1] is not None
+
+    def run(self):
+        try:
+            next_flush = time.time() + self.flush_interval
+            while self.write_pending(max(0, next_flush - time.time())):
+                if time.time() >= next_flush:
+                    self.writer.flush()
+                    next_flush = time.time() + self.flush_interval
+            self.writer.flush()
+        except Exception as ex:
+            self.failed = True
+            log("dump: can't write "+self.writer.path+", dump stopped... "+str(ex))
+
+    def close(self):
+        #At exit: wait for the writer to write the rows still queued
+        if not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, True, 10)
+        except Queue.Full:
+            return
+        self.thread.join(10)
+
+class RawWriter:
+    #Frames received from the hosts, for --replay: a first line "MONRAW1 <hosts>", then each chunk of data read from a host
+    #preceded by a line "<host> <reception time in ms> <size>". The chunks are written as received (partial frames
+    #included), --replay feeds them to read_frames again.
+    def __init__(self, path, hosts):
+        self.path = path
+        self.file = open(path, 'wb', 1048576)
+        self.file.write(RAW_MAGIC+",".join(hosts)+"\n")
+
+    def write(self, chunks):
+        for host, received, data in chunks:
+            self.file.write("%s %d %d\n" % (host, received, len(data)))
+            self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+def read_raw(path):
+    #(host, reception time in ms, data) of each chunk of a file written by RawWriter. Read sequentially, the file isn't
+    #loaded in memory. A chunk cut by a crash ends the file.
+    with open(path, 'rb', 1048576) as raw_file:
+        raw_file.readline()
+        while True:
+            header = raw_file.readline().split(" ")
+            if len(header) != 3:
+                return
+            data = raw_file.read(int(header[2]))
+            if len(data) < int(header[2]):
+                return
+            yield header[0], int(header[1]), data
+
+dump = None
+raw_dump = None
+
+#Metrics of the OpenMetrics endpoint (--metrics_port), all gauges: column of CLUSTER_COLUMNS, name, help
+EXPORTED_METRICS = [("cpu", "monitoring_cpu_busy_ratio", "Busy time of the cpus during the last measure (0 -> 1)"),
+                    ("cpu_user", "monitoring_cpu_user_ratio", "User time of the cpus during the last measure (0 -> 1)"),
+                    ("cpu_nice", "monitoring_cpu_nice_ratio", "Nice time of the cpus during the last measure (0 -> 1)"),
+                    ("cpu_max_core", "monitoring_cpu_max_core_busy_ratio", "Busy time of the busiest core during the last measure (0 -> 1)"),
+                    ("hot_cores", "monitoring_cpu_hot_cores", "Number of cores busier than --core_threshold"),
+                    ("avgqu-sz", "monitoring_disk_queue_size", "Average queue size of the disks"),
+                    ("r/s", "monitoring_disk_reads_per_second", "Reads completed per second"),
+                    ("sector_r", "monitoring_disk_read_sectors_per_second", "Sectors read per second"),
+                    ("r_await", "monitoring_disk_read_await_milliseconds", "Average time of the reads"),
+                    ("w/s", "monitoring_disk_writes_per_second", "Writes completed per second"),
+                    ("sector_w", "monitoring_disk_written_sectors_per_second", "Sectors written per second"),
+                    ("w_await", "monitoring_disk_write_await_milliseconds", "Average time of the writes"),
+                    ("disk_util", "monitoring_disk_util_percent", "%util of the busiest device"),
+                    ("rx_bytes/s", "monitoring_network_received_bytes_per_second", "Bytes received per second"),
+                    ("rx_ok", "monitoring_network_received_packets", "Packets received during the last measure"),
+                    ("rx_ko", "monitoring_network_receive_errors", "Receive errors, drops and overruns during the last measure"),
+                    ("tx_bytes/s", "monitoring_network_transmitted_bytes_per_second", "Bytes transmitted per second"),
+                    ("tx_ok", "monitoring_network_transmitted_packets", "Packets transmitted during the last measure"),
+                    ("tx_ko", "monitoring_network_transmit_errors", "Transmit errors, drops and overruns during the last measure"),
+                    ("connection_active", "monitoring_tcp_active_opens", "TCP connections opened during the last measure"),
+                    ("connection_fail", "monitoring_tcp_attempt_fails", "TCP connection attempts failed during the last measure"),
+                    ("gc_count", "monitoring_gc_pauses", "Stop the world pauses during the last measure"),
+                    ("gc_total_ms", "monitoring_gc_pause_total_milliseconds", "Total duration of the stop the world pauses during the last measure"),
+                    ("gc_max_ms", "monitoring_gc_pause_max_milliseconds", "Longest stop the world pause during the last measure"),
+                    ("warning", "monitoring_log_warnings", "WARN lines logged during the last --log_grep_freq measures"),
+                    ("error", "monitoring_log_errors", "ERROR lines logged during the last --log_grep_freq measures")]
+
+def quote_label(value):
+    #Label value of the OpenMetrics text
+    return '"'+value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")+'"'
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        text = self.server.exporter.text()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        #Not on the screen
+        pass
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class MetricsExporter:
+    #OpenMetrics endpoint. The text is built from the snapshots of the hosts and served as is to the next scrapes.
+    #The hosts report at different times of each measure interval, so new measures rebuild it at most once per
+    #--measure_frequency (a scrape gets measures at most one interval old): any number of scrapers costs at most one
+    #rendering per sample. A host connecting or disconnecting rebuilds it at the next scrape (monitoring_up).
+    def __init__(self, address, port):
+        self.lock = threading.Lock()
+        self.measures = -1
+        self.state_changes = -1
+        self.tick = -1
+        self.cache = ""
+        self.server = MetricsServer((address, port), MetricsHandler)
+        self.server.exporter = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def text(self):
+        with self.lock:
+            tick = int(time.time() / args.measure_frequency)
+            if observer.state_changes != self.state_changes or (observer.measures != self.measures and tick != self.tick):
+                self.measures = observer.measures
+                self.state_changes = observer.state_changes
+                self.tick = tick
+                self.cache = self.render()
+            return self.cache
+
+    def render(self):
+        snapshots = [observer.hosts[host_name].snapshot for host_name in args.hosts]
+        lines = ["# TYPE monitoring_up gauge", "# HELP monitoring_up 1 if the measures of the host are received"]
+        for host in snapshots:
+            lines.append("monitoring_up{host="+quote_label(host.name)+"} "+("1" if scheduler.state.get(host.name) == remote.STREAMING else "0"))
+        lines.extend(["# TYPE monitoring_last_measure_timestamp_seconds gauge", "# HELP monitoring_last_measure_timestamp_seconds Time of the last measure of the host"])
+        for host in snapshots:
+            if host.timestamp > 0:
+                lines.append("monitoring_last_measure_timestamp_seconds{host="+quote_label(host.name)+"} "+repr(host.timestamp / 1000.0))
+        for column, name, help in EXPORTED_METRICS:
+            idx = CLUSTER_INDEX[column]
+            lines.extend(["# TYPE "+name+" gauge", "# HELP "+name+" "+help])
+            for host in snapshots:
+                if host.derived is None or host.derived[idx] != host.derived[idx]:
+                    continue
+                labels = "{host="+quote_label(host.name)+(",device="+quote_label(host.worst_device) if column == "disk_util" else "")+"}"
+                lines.append(name+labels+" "+repr(float(host.derived[idx])))
+        lines.append("# EOF")
+        return "\n".join(lines)+"\n"
+
+cluster = ClusterMatrix(args.hosts)
+
 observer = HostObserver()
 
 def clean(line):
@@ -326,69 +1131,436 @@ def clean(line):
 
 results = {}
 
-def execute_remote_command(host):
+agent_source = None
+if args.agent:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "monitoring_agent.py"), 'rb') as agent_file:
+        agent_source = agent_file.read()
+
+def agent_command():
+    python = args.agent_python if args.agent_python != "" else '$(command -v python3 || command -v python)'
+    return 'exec '+python+' - --measure_frequency='+str(args.measure_frequency)+' --log_grep_freq='+str(args.log_grep_freq) + \
+           ' --log_file="'+("" if args.log_file is None else args.log_file)+'" --gc_log_file="'+("" if args.gc_log_file is None else args.gc_log_file)+'"' + \
+           ' --data_dirs="'+args.data_dirs+'"'
+
+def shell_command():
+    #Same frames as the agent (see read_frames). LC_ALL=C so that ${#var} is a length in bytes.
+    log_command = 'log="" ; '
+    gc_command = 'gc="" ; '
+    dirs_command = 'dirs="" ; '
+    if args.log_file is not None and args.log_file != "":
+        #Remember the inode and the size of the log at each count and only read the bytes appended since then.
+        #Start at the end of the file, and from the beginning of the new file when the log is rotated (inode change or truncated).
+        #When rotated, the end of the old file (found by its inode in the same directory) is counted first, like the agent.
+        log_command += 'idx=$((idx+1)); if [ $((idx%'+str(args.log_grep_freq)+')) = 0 ] ; then set -- $(stat -Lc "%i %s" '+args.log_file+' 2>/dev/null) ; ' \
+                       'if [ -n "$1" ] ; then log_old="" ; ' \
+                       'if [ -z "$log_inode" ] ; then log_offset=$2 ; ' \
+                       'elif [ "$1" != "$log_inode" ] ; then log_old=$(find "$(dirname '+args.log_file+')" -maxdepth 1 -inum $log_inode 2>/dev/null | head -n 1) ; log_old_offset=$log_offset ; log_offset=0 ; ' \
+                       'elif [ "$2" -lt "$log_offset" ] ; then log_offset=0 ; fi ; log_inode=$1 ; ' \
+                       'log=$({ if [ -n "$log_old" ] ; then tail -c +$((log_old_offset+1)) "$log_old" ; fi ; tail -c +$((log_offset+1)) '+args.log_file+' | head -c $(($2-log_offset)) ; } | awk "/ERROR/{e++} /WARN/{w++} END{print e+0, w+0}") ; log_offset=$2 ; ' \
+                       'fi ; fi ; '
+    if args.gc_log_file is not None and args.gc_log_file != "":
+        #Same as the log: only read the bytes appended since the previous measure. With a pattern, follow the most recent file.
+        if any(c in args.gc_log_file for c in "*?["):
+            gc_command += 'gc_file=$(ls -t '+args.gc_log_file+' 2>/dev/null | head -n 1) ; '
+        else:
+            gc_command += 'gc_file="'+args.gc_log_file+'" ; '
+        #When the file changes, the end of the previous one (found by its inode) is read first.
+        gc_command += 'set -- $(stat -Lc "%i %s" "$gc_file" 2>/dev/null) ; ' \
+                      'if [ -n "$1" ] ; then gc_old="" ; ' \
+                      'if [ -z "$gc_inode" ] ; then gc_offset=$2 ; ' \
+                      'elif [ "$1" != "$gc_inode" ] ; then gc_old=$(find "$(dirname "$gc_file")" -maxdepth 1 -inum $gc_inode 2>/dev/null | head -n 1) ; gc_old_offset=$gc_offset ; gc_offset=0 ; ' \
+                      'elif [ "$2" -lt "$gc_offset" ] ; then gc_offset=0 ; fi ; gc_inode=$1 ; ' \
+                      'gc=$({ if [ -n "$gc_old" ] ; then tail -c +$((gc_old_offset+1)) "$gc_old" ; fi ; tail -c +$((gc_offset+1)) "$gc_file" | head -c $(($2-gc_offset)) ; } | grep -o "threads were stopped: [0-9.,]*") ; gc_offset=$2 ; ' \
+                      'fi ; '
+    if args.data_dirs != "":
+        #Device of each data directory (hexadecimal), to find them in /proc/diskstats. Computed once, before the loop.
+        dirs_command = 'dirs=$(stat -Lc "%D %n" '+" ".join(['"'+path+'"' for path in args.data_dirs.split(",") if path != ""])+' 2>/dev/null) ; '
+    command = 'export LC_ALL=C ; unset log_inode gc_inode ; idx=-1 ; log_offset=0 ; gc_offset=0 ; ' + dirs_command + 'while true ; do ' \
+              'proc_stat=$(grep "^cpu" /proc/stat) ; diskstats=$(cat /proc/diskstats) ; netdev=$(cat /proc/net/dev) ; snmp=$(grep "^Tcp:" /proc/net/snmp) ; ' \
+              'date_ms=$(($(date +%s%N)/1000000)) ; ' + log_command + gc_command + \
+              'printf "__FRAME__ stat:%d diskstats:%d netdev:%d snmp:%d date:%d log:%d gc:%d dirs:%d\\n%s%s%s%s%s%s%s%s" ' \
+              '${#proc_stat} ${#diskstats} ${#netdev} ${#snmp} ${#date_ms} ${#log} ${#gc} ${#dirs} "$proc_stat" "$diskstats" "$netdev" "$snmp" "$date_ms" "$log" "$gc" "$dirs" ; ' \
+              'sleep '+str(args.measure_frequency)+' ; done'
+    return command
+
+#All the ssh streams are read by a single thread running the loop
+ssh = None if args.local or args.replay != "" else remote.Ssh(args.user, args.key, args.ssh_persist)
+loop = remote.RemoteLoop(on_error=log)
+streams = {}
+first_report = threading.Event()
+#Set by each new measure, wakes up the display
+updated = threading.Event()
+
+def connect(host):
     try:
-        print 'Initializing connection with host '+args.user+'@'+host+'...'
-        gc_command = ""
-        error_command = ""
-        if args.gc_log_file is not None and args.gc_log_file != "":
-            gc_command = '&& tail -n 200 '+args.gc_log_file+' | tac | grep -m 1 "threads were stopped"'
-        #TODO: find something more performant
-        if args.log_file is not None and args.log_file != "":
-            error_command = 'idx=$((idx+1)); if [ $((idx%'+str(args.log_grep_freq)+')) = 0 ] ; then echo "__ERROR__$(grep ERROR '+args.log_file+' | wc -l)" && echo "__WARN__$(grep WARN '+args.log_file+' | wc -l)" ; fi; '
-        command = 'unset idx;idx=-1;echo $idx; while true; do echo "IDX=$idx"; ' + error_command + \
-                  ' cat /proc/diskstats && cat /proc/stat ' \
-                  ' ; echo "__NETSTAT_START__"' \
-                  ' && netstat -i' \
-                  ' && netstat -s | egrep "(active connections opening|failed connection attempts)"' \
-                  ' ; echo "__NETSTAT_END__" ' \
-                  ' ; echo "__DATE__$(($(date +%s%N)/1000000))"' + \
-                    gc_command + \
-                  ' ; echo "__END__" ; sleep '+str(args.measure_frequency)+'; done'
-        p = subprocess.Popen("ssh -o StrictHostKeychecking=no "+("" if args.key == "" else "-i "+args.key+" ") +args.user+"@"+host+" '"+ command+"'", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        #print "ssh -o StrictHostKeychecking=no "+args.user+"@"+host+" '"+ command+"'"
-        #print "ssh -o StrictHostKeychecking=no "+("" if args.key == "" else "-i "+args.key+" ") +args.user+"@"+host+" '"+ command+"'"
-        #print 'Connected to '+args.user+'@'+host+'. Listening updates'
-        buffer = []
-        while True:
-            line = p.stdout.readline()
-            if "__END__" in line:
-                observer.updateHost(host, buffer)
-                buffer = []
-            else:
-                buffer.append(line)
+        log('Initializing connection with host '+args.user+'@'+host+'...')
+        command = agent_command() if args.agent else shell_command()
+        #exec: the process of the stream is ssh itself, so that cancel_connection can stop it
+        ssh_command = "exec "+ssh.command(host, command)
+        if args.ssh_persist > 0:
+            ssh_command = ssh.master_command(host)+" ; "+ssh_command
+        p = remote.execute(ssh_command, stdin=subprocess.PIPE if args.agent else None)
+        if args.agent:
+            #The agent is read by "python -" on the node until stdin is closed
+            p.stdin.write(agent_source)
+            p.stdin.close()
+        streams[host] = {"buffer": "", "sections": None, "size": 0, "process": p}
+        loop.add(host, p, on_host_data, on_host_close)
+    except Exception as ex:
+        log("connection error with host "+host+"... "+str(ex))
+        scheduler.closed(host)
+
+def read_frames(stream, data):
+    #The remote side (shell loop or agent) sends one frame per measure:
+    #  __FRAME__ stat:1234 diskstats:5678 netdev:910 snmp:112 date:13 log:4 gc:0 dirs:48\n
+    #followed by the content of each section, with the given length in bytes. The sections are sliced by their
+    #length: only the header line is searched, the payload is never scanned for sentinels.
+    #Returns the complete frames ({section: content}) and the lines received outside of a frame (errors).
+    buffer = stream["buffer"] + data
+    pos = 0
+    frames = []
+    errors = []
+    while True:
+        if stream["sections"] is None:
+            end = buffer.find("\n", pos)
+            if end == -1:
+                break
+            header = buffer[pos:end]
+            pos = end + 1
+            if not header.startswith("__FRAME__ "):
+                errors.append(header)
+                continue
+            sections = []
+            try:
+                for section in header[len("__FRAME__ "):].split(" "):
+                    name, size = section.split(":")
+                    sections.append((name, int(size)))
+            except ValueError:
+                sections = None
+            if sections is None or any(size < 0 for name, size in sections):
+                #Corrupted or cut stream: skipped, the next header line starts a new frame
+                errors.append("invalid frame header: "+header[:200])
+                continue
+            stream["sections"] = sections
+            stream["size"] = sum(size for name, size in sections)
+        if len(buffer) - pos < stream["size"]:
+            break
+        frame = {}
+        for name, size in stream["sections"]:
+            frame[name] = buffer[pos:pos+size]
+            pos += size
+        stream["sections"] = None
+        frames.append(frame)
+    stream["buffer"] = buffer[pos:]
+    return frames, errors
+
+def on_host_data(host, data):
+    if raw_dump is not None:
+        raw_dump.add((host, int(time.time() * 1000), data))
+    try:
+        frames, errors = read_frames(streams[host], data)
     except Exception as ex:
-        print "connection error with host "+host+"... "+sys.exc_info()[0]+" retry connection in 1 sec..."
-    finally:
-        print "streaming has stopped for unknwon reason. Retrying in 1 sec..."
-        time.sleep(1)
-        execute_remote_command(host)
+        #Start again from the next frame
+        log("error reading the stream of host "+host+"... "+str(ex))
+        streams[host].update({"buffer": "", "sections": None, "size": 0})
+        return
+    for line in errors:
+        log(host+": "+line)
+    for frame in frames:
+        #Connected once a first complete measure is received (ssh errors are also sent on stdout)
+        if scheduler.state.get(host) != remote.STREAMING:
+            scheduler.connected(host)
+            observer.state_changes += 1
+            first_report.set()
+        try:
+            observer.updateHost(host, frame)
+        except Exception as ex:
+            log("error reading the measure of host "+host+"... "+str(ex))
+
+def cancel_connection(host):
+    #No measure received since the connection started: stopped, on_host_close backs off and retries
+    log("no measure received from host "+host+" after "+str(args.connect_timeout)+"s, restarting the connection.")
+    try:
+        streams[host]["process"].kill()
+    except (KeyError, OSError):
+        pass
 
+def on_host_close(host, returncode):
+    log("streaming with host "+host+" has stopped (exit code "+str(returncode)+").")
+    cluster.clear(host)
+    scheduler.closed(host)
+    observer.state_changes += 1
 
-for host in args.hosts:
-    t = threading.Thread(target=execute_remote_command, args=(host,))
-    t.setDaemon(True)
-    t.start()
-    time.sleep(0.2)
+def benchmark(cores=64, devices=40, interfaces=8, iterations=2000):
+    #Same frame as the shell loop would send for such a host (/proc/stat with the per cpu, intr and softirq lines)
+    import monitoring_agent
+    def build_frame(tick):
+        stat = ["cpu  %d 10 %d 9000000 50 0 %d 0 0 0" % (1000+tick*cores, 500+tick, 20+tick)]
+        for cpu in range(cores):
+            stat.append("cpu%d %d 1 %d 140000 1 0 %d 0 0 0" % (cpu, 100+tick, 50+tick, 2+tick))
+        stat.append("intr %d " % (tick*1000) + " ".join(["0"] * 3000))
+        stat.append("ctxt 123456789\nbtime 1500000000\nprocesses 123456\nprocs_running 2\nprocs_blocked 0")
+        stat.append("softirq %d 0 1 2 3 4 5 6 7 8" % tick)
+        diskstats = []
+        for device in range(devices):
+            diskstats.append("   8 %7d sd%s%s %d 1 %d 10 %d 2 %d 20 0 %d %d 0 0 0 0" % (device*16, chr(97+device//26), chr(97+device%26), 100+tick, 800+tick*8, 200+tick, 1600+tick*8, 30+tick, 40+tick))
+        netdev = ["Inter-|   Receive                                                |  Transmit",
+                  " face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed"]
+        for interface in range(interfaces):
+            netdev.append("  eth%d: %d %d 0 0 0 0 0 0 %d %d 0 0 0 0 0 0" % (interface, 100000+tick*1500, 1000+tick, 200000+tick*1500, 2000+tick))
+        snmp = "Tcp: RtoAlgorithm RtoMin RtoMax MaxConn ActiveOpens PassiveOpens AttemptFails EstabResets CurrEstab InSegs OutSegs RetransSegs InErrs OutRsts InCsumErrors\n" \
+               "Tcp: 1 200 120000 -1 %d 50 %d 2 20 1000 1000 0 0 1 0" % (100+tick, tick)
+        return monitoring_agent.frame([("stat", "\n".join(stat)), ("diskstats", "\n".join(diskstats)), ("netdev", "\n".join(netdev)),
+                                       ("snmp", snmp), ("date", str(1500000000000+tick*1000)), ("log", "1 2"), ("gc", "threads were stopped: 0.0123")])
+    frames = [build_frame(tick) for tick in range(10)]
+    stream = {"buffer": "", "sections": None, "size": 0}
+    read_time = 0
+    parse_time = 0
+    for i in range(iterations):
+        start = time.time()
+        frame, errors = read_frames(stream, frames[i % len(frames)])
+        read_time += time.time() - start
+        start = time.time()
+        observer.updateHost("benchmark", frame[0])
+        parse_time += time.time() - start
+    print "host with "+str(cores)+" cores, "+str(devices)+" block devices and "+str(interfaces)+" interfaces, frame of "+str(len(frames[0]))+" bytes, "+str(iterations)+" measures:"
+    print "  read_frames: %.1f us / measure" % (read_time / iterations * 1000000)
+    print "  updateHost:  %.1f us / measure" % (parse_time / iterations * 1000000)
+    print "  total:       %.1f us / measure, %.0f measures / sec" % ((read_time + parse_time) / iterations * 1000000, iterations / (read_time + parse_time))
 
-time.sleep(2)
+def benchmark_replay():
+    #Parse the frames of a recording (--replay), loaded in memory first so that only the parsing is measured
+    chunks = list(read_raw(args.replay))
+    replay_streams = {}
+    read_time = 0
+    parse_time = 0
+    measures = 0
+    for host, received, data in chunks:
+        stream = replay_streams.setdefault(host, {"buffer": "", "sections": None, "size": 0})
+        start = time.time()
+        frames, errors = read_frames(stream, data)
+        read_time += time.time() - start
+        for frame in frames:
+            start = time.time()
+            observer.updateHost(host, frame)
+            parse_time += time.time() - start
+            measures += 1
+    if measures == 0:
+        sys.exit("No frame in "+args.replay)
+    print args.replay+": "+str(len(replay_streams))+" host(s), "+str(sum([len(data) for host, received, data in chunks]))+" bytes, "+str(measures)+" measures:"
+    print "  read_frames: %.1f us / measure" % (read_time / measures * 1000000)
+    print "  updateHost:  %.1f us / measure" % (parse_time / measures * 1000000)
+    print "  total:       %.1f us / measure, %.0f measures / sec" % ((read_time + parse_time) / measures * 1000000, measures / (read_time + parse_time))
+
+if args.benchmark:
+    if args.replay != "":
+        benchmark_replay()
+    else:
+        benchmark()
+    sys.exit(0)
 
 if args.dump_result and args.dump_to and args.dump_to != "":
-    with open(args.dump_to, 'wb') as csvfile:
-        csv_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        csv_writer.writerow(["host","cpu-avg","cpu-user","cpu-nice","avgqu-sz","r/s","sector_r","r_await","w/s","sector_w","w_await","rx_ok","rx_ko","tx_ok","tx_ko","connection_active","connection_fail","last_gc_duration_ms","warning","error"])
+    csv_header = list(CSV_HEADER)
+    if args.dump_history:
+        csv_header += [metric+"-"+column for metric in HISTORY_METRICS for column in HISTORY_COLUMNS]
+    if args.dump_format == "binary":
+        dump = Dump(RecordingWriter(args.dump_to, csv_header), args.dump_flush)
+    else:
+        dump = Dump(CsvWriter(args.dump_to, csv_header), args.dump_flush)
+if args.record_raw != "":
+    raw_dump = Dump(RawWriter(args.record_raw, args.hosts), args.dump_flush)
+
+scheduler = remote.ReconnectScheduler(loop, connect, max_delay=args.max_retry_delay, max_concurrent=args.max_connecting,
+                                      connect_timeout=args.connect_timeout, cancel=cancel_connection)
+
+if args.metrics_port > 0:
+    exporter = MetricsExporter(args.metrics_address, args.metrics_port)
+
+def sample_local(host, collector, next_tick):
+    #Same collector as the agent, executed in-process and parsed like a remote stream.
+    #A failed measure (transient /proc or log read error) is logged, the next one is still scheduled.
+    try:
+        on_host_data(host, collector.sample())
+    except Exception as ex:
+        log("error sampling "+host+"... "+str(ex))
+    next_tick = max(next_tick + args.measure_frequency, time.time())
+    loop.call_later(next_tick - time.time(), sample_local, host, collector, next_tick)
+
+def replay():
+    #Feed the recorded data to on_host_data like the collection loop would, at --replay_speed times the speed of the recording
+    for host in args.hosts:
+        scheduler.state[host] = "waiting for the replay"
+    start = time.time()
+    first = None
+    for host, received, data in read_raw(args.replay):
+        if host not in streams:
+            streams[host] = {"buffer": "", "sections": None, "size": 0}
+        if first is None:
+            first = received
+        if args.replay_speed > 0:
+            delay = start + (received - first) / 1000.0 / args.replay_speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        on_host_data(host, data)
+    for host in args.hosts:
+        if scheduler.state[host] != remote.STREAMING:
+            scheduler.state[host] = "no measure in the recording"
+    observer.state_changes += 1
+    log("end of the replay of "+args.replay)
+
+if args.replay != "":
+    #No connection, the data comes from the recording
+    collector = threading.Thread(target=replay)
+else:
+    if args.local:
+        import monitoring_agent
+        streams["localhost"] = {"buffer": "", "sections": None, "size": 0}
+        local_collector = monitoring_agent.Collector(args.log_file or "", args.log_grep_freq, args.gc_log_file or "", args.data_dirs)
+        loop.call_later(0, sample_local, "localhost", local_collector, time.time())
+    else:
+        for host in args.hosts:
+            scheduler.start(host)
+    collector = threading.Thread(target=loop.run_forever)
+collector.setDaemon(True)
+collector.start()
+
+#Start rendering as soon as a first host reports
+first_report.wait(10)
+rendering.set()
+
+last_frame = 0
+
+def wait_next_frame():
+    #Until new measures are received (and at least every second, for the connection states), at most --max_fps frames per second
+    global last_frame
+    delay = last_frame + 1.0 / args.max_fps - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    updated.wait(1)
+    updated.clear()
+    last_frame = time.time()
+
+def draw(lines):
+    #The frame, then the last messages of the collection
+    screen.draw(lines, [""] + list(messages) if len(messages) > 0 else [])
+
+def stack_halves(first, second):
+    #The 2 tables of the small screen one under the other. When they don't fit in the terminal, each one is cut to half of
+    #the height, so that the second one is displayed as well
+    height = screen.terminal_size()[0] - 1 - (len(messages) + 1 if len(messages) > 0 else 0)
+    if not screen.tty or len(first) + 1 + len(second) <= height:
+        return first + [""] + second
+    rows = max(1, (height - 1) // 2)
+    return cut_lines(first, rows) + [""] + cut_lines(second, height - 1 - rows)
+
+#Columns of the per device view, in the order of Host.device_values: name, separator, format, warn, error, width
+DEVICE_COLUMNS = [("r/s", "| ", format_float, 500, 5000, 9), ("w/s", "", format_float, 500, 5000, 9),
+                  ("rMB/s", "", format_float, 200, 500, 9), ("wMB/s", "", format_float, 200, 500, 9),
+                  ("r_await", "| ", format_float, 30, 100, 10), ("w_await", "", format_float, 30, 100, 10),
+                  ("avgqu-sz", "| ", format_float, 10, 100, 10), ("%util", "", format_float, 60, 90, 7)]
+
+def devices_report(host):
+    #One line per selected device of the host
+    lines = []
+    for name, role, values in host.devices_derived:
+        report = (host.name+":").ljust(20, " ")+name.ljust(12, " ")+role.ljust(20, " ")
+        for (column, separator, formatter, warn, error, width), value in zip(DEVICE_COLUMNS, values):
+            report += separator+formatter(value, warn, error, width)
+        lines.append(report)
+    return lines
+
+#Columns of the per core view, in the order of Host.core_values: name, warn, error
+CORE_COLUMNS = [("busy", 0.7, 0.9), ("user", 0.7, 0.9), ("system", 0.3, 0.5), ("iowait", 0.1, 0.3), ("irq", 0.1, 0.3), ("softirq", 0.1, 0.3), ("steal", 0.05, 0.1)]
+
+def cores_report(host):
+    #One line per core of the host, by core number
+    lines = []
+    for name, values in sorted(host.cores_derived, key=lambda core: int(core[0][3:])):
+        report = (host.name+":").ljust(20, " ")+name.ljust(8, " ")+"| "
+        for (column, warn, error), value in zip(CORE_COLUMNS, values):
+            report += format_float(value, warn, error, 9)
+        lines.append(report)
+    return lines
+
+def history_report(host):
+    #One group of columns per metric: 1m/5m/15m averages, 15m max and p99
+    groups = []
+    for metric, summary in zip(HISTORY_METRICS, host.history_summary):
+        warn, error = HISTORY_THRESHOLDS[metric]
+        groups.append("| "+"".join([format_float(value, warn, error, 7) for value in summary]))
+    return groups
+
+while threading.active_count() > 0 and args.view == "cores":
+    lines_to_print = []
+    header = "host".ljust(20, " ")+"core".ljust(8, " ")+"| "+"".join([column.ljust(9, " ") for column, warn, error in CORE_COLUMNS])
+    lines_to_print.append(header)
+    lines_to_print.append("".ljust(len(header), "-"))
+    for host_name in args.hosts:
+        host = observer.hosts[host_name].snapshot
+        state = scheduler.describe(host_name)
+        if state != remote.STREAMING:
+            lines_to_print.append((host.name+":").ljust(20, " ")+state)
+        elif host.derived is None:
+            lines_to_print.append((host.name+":").ljust(20, " ")+"waiting for the first measures")
+        else:
+            lines_to_print.extend(cores_report(host))
+    draw(lines_to_print)
+    wait_next_frame()
+
+while threading.active_count() > 0 and args.view == "devices":
+    lines_to_print = []
+    header = "host".ljust(20, " ")+"device".ljust(12, " ")+"data dirs".ljust(20, " ")
+    for column, separator, formatter, warn, error, width in DEVICE_COLUMNS:
+        header += separator+column.ljust(width, " ")
+    lines_to_print.append(header)
+    lines_to_print.append("".ljust(len(header), "-"))
+    for host_name in args.hosts:
+        host = observer.hosts[host_name].snapshot
+        state = scheduler.describe(host_name)
+        if state != remote.STREAMING:
+            lines_to_print.append((host.name+":").ljust(20, " ")+state)
+        elif host.derived is None:
+            lines_to_print.append((host.name+":").ljust(20, " ")+"waiting for the first measures")
+        elif len(host.devices_derived) == 0:
+            lines_to_print.append((host.name+":").ljust(20, " ")+"no device matching "+(args.devices if len(device_patterns) > 0 else "the data dirs"))
+        else:
+            lines_to_print.extend(devices_report(host))
+    draw(lines_to_print)
+    wait_next_frame()
+
+while threading.active_count() > 0 and args.view == "history":
+    #Lines split in groups of columns (host, then one group per metric), the small screen shows the groups in 2 tables
+    groups_to_print = []
+    groups_to_print.append([" ".ljust(20, " ")] + [("| "+metric.upper()).ljust(37, " ") for metric in HISTORY_METRICS])
+    groups_to_print.append(["host".ljust(20, " ")] + ["| "+"".join([column.ljust(7, " ") for column in ("1m", "5m", "15m", "max", "p99")]) for metric in HISTORY_METRICS])
+    groups_to_print.append(["".ljust(20, "-")] + ["".ljust(37, "-") for metric in HISTORY_METRICS])
+    for host_name in args.hosts:
+        host = observer.hosts[host_name].snapshot
+        state = scheduler.describe(host_name)
+        if args.history <= 0:
+            groups_to_print.append([(host.name+":").ljust(20, " "), "history disabled (--history=0)"])
+        elif host.history_summary is None:
+            groups_to_print.append([(host.name+":").ljust(20, " "), state if state != remote.STREAMING else "waiting for the first measures"])
+        else:
+            groups_to_print.append([(host.name+":").ljust(20, " ")] + history_report(host))
+    if args.small_screen:
+        draw(stack_halves(["".join(groups[:4]) for groups in groups_to_print], ["".join(groups[:1] + groups[4:]) for groups in groups_to_print]))
+    else:
+        draw(["".join(groups) for groups in groups_to_print])
+    wait_next_frame()
 
 while threading.active_count() > 0:
-    do_not_print_result = os.system("clear")
     lines_to_print = []
-    meta_header_1 = " ".ljust(23, " ")+"CPU (0 -> 1)".ljust(18, " ")+"|"+" I/O (ALL) |".ljust(20, " ")+"ALL DISKS READ".ljust(23, " ")+"|".ljust(10, " ")+"ALL DISKS WRITE".ljust(22, " ")
+    meta_header_1 = " ".ljust(23, " ")+"CPU (0 -> 1)".ljust(30, " ")+"|"+" I/O (ALL) |".ljust(20, " ")+"ALL DISKS READ".ljust(23, " ")+"|".ljust(10, " ")+"ALL DISKS WRITE".ljust(22, " ")
     short_display_len=len(meta_header_1)
-    meta_header_1 += "|".ljust(5, " ")+("NETWORK (ALL INTERFACES, t/rx "+("WITHOUT" if args.exclude_lo else "WITH") +" LO)").ljust(45, " ")+"|    JVM    |  LOGS (last "+str(args.log_grep_freq)+"sec)"
+    meta_header_1 += "|".ljust(5, " ")+("NETWORK (ALL INTERFACES, t/rx "+("WITHOUT" if args.exclude_lo else "WITH") +" LO)").ljust(63, " ")+"|"+"    JVM PAUSES".ljust(22, " ")+("|  LOGS (last "+str(args.log_grep_freq*args.measure_frequency)+"sec)").ljust(22, " ")+"|  BUSIEST DISK"
     lines_to_print.append(meta_header_1)
     header = "host".ljust(20, " ")
     header += "avg".ljust(7, " ")
     header += "user".ljust(7, " ")
-    header += "nice".ljust(7, " ")+"| "
+    header += "nice".ljust(7, " ")
+    header += "core".ljust(7, " ")
+    header += "hot".ljust(5, " ")+"| "
     header += "avgqu-sz".ljust(10, " ")+"| "
     header += "r/s".ljust(10, " ")
     header += "sector_r".ljust(10, " ")
@@ -396,73 +1568,46 @@ while threading.active_count() > 0:
     header += "w/s".ljust(10, " ")
     header += "sector_w".ljust(10, " ")
     header += "w_await".ljust(10, " ")+"| "
+    header += "rx_B/s".ljust(9, " ")
     header += "rx_ok".ljust(7, " ")
     header += "rx_ko".ljust(7, " ")
+    header += "tx_B/s".ljust(9, " ")
     header += "tx_ok".ljust(7, " ")
     header += "tx_ko".ljust(7, " ")
     header += "conn_act".ljust(10, " ")
     header += "conn_fail".ljust(10, " ")+"|"
-    header += "last_gc_ms".ljust(11, " ")+"|"
+    header += "gc_n".ljust(6, " ")
+    header += "gc_ms".ljust(8, " ")
+    header += "max_ms".ljust(8, " ")+"|"
     header += "warn".ljust(10, " ")
-    header += "error".ljust(10, " ")
+    header += "error".ljust(11, " ")+"| "
+    header += "%util".ljust(7, " ")
+    header += "device".ljust(10, " ")
     lines_to_print.append(header)
     lines_to_print.append("".ljust(len(header), "-"))
+    if args.summary and len(args.hosts) > 1:
+        summary, outliers = cluster.summary()
+        for label, values in zip(CLUSTER_SUMMARY_ROWS, summary):
+            lines_to_print.append(label.ljust(20, " ")+format_values(values, label != "total/avg"))
+        lines_to_print.append("outliers: "+(", ".join([host+" ("+CLUSTER_COLUMNS[col][0]+" %.2f)" % value for score, host, col, value in outliers[:5] if score > 3]) or "none"))
+        lines_to_print.append("".ljust(len(header), "-"))
 
     for host_name in args.hosts:
-        host = observer.hosts[host_name]
-        host.mutex.acquire()
-        try:
-            report = ((host.name+":").ljust(20, " "))
-            if host.timestamp == -2:
-                report += "ERROR reading timestamp. Check connection/errors. Make sure logs path are correct."
-            if host.cpu is None:
-                report += "CPU reading error / check connection (will try to reconnect every sec)"
-            else:
-                report += format_float(host.percent_cpu(), 0.7, 0.9, 7)
-                report += format_float(host.cpu_stat('user'), 0.7, 0.9, 7)
-                report += format_float(host.cpu_stat('nice'), 0.7, 0.9, 7)
-                report += "| "+format_float(host.all_devices_stat_ms('weighted_io_time'), 10, 100, 10)
-                report += "| "+format_float((host.all_devices_stat_ms('read_completed')*1000), 500, 5000, 10)
-                report += format_int((host.all_devices_stat_ms('sectors_read')*1000), 1000, 10000, 10)
-                report += format_float(host.all_r_await(), 30, 100, 10)
-                report += "| "+format_float((host.all_devices_stat_ms('write_completed')*1000), 500, 5000, 10)
-                report += format_int((host.all_devices_stat_ms('sectors_written')*1000), 1000, 10000, 10)
-                report += format_float(host.all_w_await(), 30, 100, 10)
-                report += "| "+format_int(host.all_interfaces_stat("tx_ok"), 10000, 100000, 7)
-                report += format_int(host.all_interfaces_stat("tx_error") + host.all_interfaces_stat("tx_dropped") + host.all_interfaces_stat("tx_overrun"), 0, 10, 7)
-                report += format_int(host.all_interfaces_stat("rx_ok"), 10000, 100000, 7)
-                report += format_int(host.all_interfaces_stat("rx_error") + host.all_interfaces_stat("rx_dropped") + host.all_interfaces_stat("rx_overrun"), 0, 10, 7)
-                report += format_int(host.connection_active - host.previous_connection_active, 50, 100, 10)
-                report += format_int(host.connection_failed - host.previous_connection_failed, 0, 10, 10)
-                report += "| "+format_float(host.jvm_stop, 100, 500, 10)
-                report += "| "+format_int(host.warn_count - host.previous_warn_count, 0, 1, 10)
-                report += format_int(host.error_count - host.previous_error_count, 0, 0, 10)
-            lines_to_print.append(report)
-
-            if args.dump_result and args.dump_to and args.dump_to != "":
-                for host_name in args.hosts:
-                    host = observer.hosts[host_name]
-                    with open(args.dump_to, 'a') as csvfile:
-                        csv_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                        csv_writer.writerow([host_name, "%.3f" % host.percent_cpu(), "%.3f" % host.cpu_stat('user'), "%.3f" % host.cpu_stat('nice'), "%.3f" % host.all_devices_stat_ms('weighted_io_time'),
-                                             "%.3f" % (host.all_devices_stat_ms('read_completed')*1000), int(host.all_devices_stat_ms('sectors_read')*1000), "%.3f" %host.all_r_await(),
-                                             int(host.all_devices_stat_ms('write_completed')*1000), int(host.all_devices_stat_ms('sectors_written')*1000), "%.3f" %host.all_w_await(),
-                                             host.all_interfaces_stat("tx_ok"), host.all_interfaces_stat("tx_error") + host.all_interfaces_stat("tx_dropped") + host.all_interfaces_stat("tx_overrun"),
-                                             host.all_interfaces_stat("rx_ok"), host.all_interfaces_stat("rx_error") + host.all_interfaces_stat("rx_dropped") + host.all_interfaces_stat("rx_overrun"),
-                                             host.connection_active - host.previous_connection_active, host.connection_failed - host.previous_connection_failed, host.jvm_stop,
-                                             host.warn_count - host.previous_warn_count, host.error_count - host.previous_error_count])
-        finally:
-            host.mutex.release()
+        host = observer.hosts[host_name].snapshot
+        report = ((host.name+":").ljust(20, " "))
+        if host.timestamp == -2:
+            report += "ERROR reading timestamp. Check connection/errors. Make sure logs path are correct."
+        state = scheduler.describe(host_name)
+        if state != remote.STREAMING:
+            report += state
+        elif host.derived is None:
+            report += "waiting for the first measures"
+        else:
+            report += format_values(host.derived, True, host.worst_device)
+        lines_to_print.append(report)
 
     if args.small_screen:
-        for l in lines_to_print:
-            print l[:short_display_len]
-        print ""
-        for l in lines_to_print:
-            print l[len(lines_to_print[0])-short_display_len:]
+        draw(stack_halves([l[:short_display_len] for l in lines_to_print], [l[len(lines_to_print[0])-short_display_len:] for l in lines_to_print]))
     else:
-        for l in lines_to_print:
-            print l
-
-
-    time.sleep(1)
+        draw(lines_to_print)
+    wait_next_frame()
@@ -0,0 +1,210 @@
+#Collector streamed by monitoring.py to the nodes over ssh stdin (--agent) and executed with "python -".
+#It keeps the /proc files open and samples everything in-process, so nothing is forked on the node at each tick.
+#Output is one frame per tick, like the shell loop of monitoring.py (see read_frames):
+#  __FRAME__ stat:<length> diskstats:<length> netdev:<length> snmp:<length> date:<length> log:<length> gc:<length> dirs:<length>\n
+#followed by the content of each section, <length> bytes each.
+#Must stay self-contained (standard library only) and run with python 2.7 and python 3.
+import argparse
+import glob
+import os
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Remote collector for monitoring.py')
+parser.add_argument('--measure_frequency', type=float, default=1)
+parser.add_argument('--log_file', type=str, default="")
+parser.add_argument('--log_grep_freq', type=int, default=1)
+parser.add_argument('--gc_log_file', type=str, default="")
+parser.add_argument('--data_dirs', type=str, default="")
+
+#Stop the world line written by the JVM in the gc log, followed by the pause duration in seconds
+GC_STOP_MARKER = b"threads were stopped: "
+
+
+class ProcFile(object):
+    #/proc file opened once and read again from the beginning at each tick
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+
+class FileFollower(object):
+    #Follow a log file like tail -F: only the bytes appended since the previous read are returned.
+    #The file stays open. When it is rotated (renamed and replaced by a new file, like logback does), the end of the
+    #old file is read before switching to the new one, so no line is lost or counted twice.
+    #The path can be a pattern (eg: gc.log.*.current): the most recent matching file is followed.
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.partial = b""
+        #Start at the end of an existing file, a file created later is read from its beginning
+        self.open(True)
+
+    def current_path(self):
+        if not glob.has_magic(self.path):
+            return self.path
+        paths = glob.glob(self.path)
+        if len(paths) == 0:
+            return None
+        return max(paths, key=os.path.getmtime)
+
+    def open(self, from_end):
+        path = self.current_path()
+        if path is None:
+            return
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return
+        if from_end:
+            f.seek(0, os.SEEK_END)
+        self.file = f
+        self.inode = os.fstat(f.fileno()).st_ino
+
+    def rotated(self):
+        try:
+            path = self.current_path()
+            if path is None:
+                return False
+            st = os.stat(path)
+        except OSError:
+            #Removed and not recreated yet, keep reading the old file
+            return False
+        #New file, or the same file truncated (copytruncate)
+        return st.st_ino != self.inode or st.st_size < self.file.tell()
+
+    def read(self):
+        #Complete lines appended since the previous call, by chunks of 1MB max
+        if self.file is None:
+            self.open(False)
+            if self.file is None:
+                return
+        rotated = self.rotated()
+        for chunk in self.read_file():
+            yield chunk
+        if rotated:
+            self.file.close()
+            self.file = None
+            self.partial = b""
+            self.open(False)
+            if self.file is not None:
+                for chunk in self.read_file():
+                    yield chunk
+
+    def read_file(self):
+        while True:
+            data = self.file.read(1048576)
+            if not data:
+                return
+            data = self.partial + data
+            end = data.rfind(b"\n") + 1
+            self.partial = data[end:]
+            if end > 0:
+                yield data[:end]
+
+
+def count_levels(data):
+    #Number of lines containing ERROR and WARN, like grep ERROR | wc -l
+    errors = 0
+    warns = 0
+    for line in data.split(b"\n"):
+        if b"ERROR" in line:
+            errors += 1
+        if b"WARN" in line:
+            warns += 1
+    return errors, warns
+
+
+def gc_stops(data):
+    #"threads were stopped: <seconds>" for each stop the world line, like grep -o
+    stops = []
+    idx = data.find(GC_STOP_MARKER)
+    while idx != -1:
+        end = idx + len(GC_STOP_MARKER)
+        while end < len(data) and data[end:end+1] in b"0123456789.,":
+            end += 1
+        stops.append(data[idx:end])
+        idx = data.find(GC_STOP_MARKER, end)
+    return stops
+
+
+def frame(sections):
+    header = b" ".join([name + b":" + str(len(data)).encode() for name, data in sections])
+    return b"__FRAME__ " + header + b"\n" + b"".join([data for name, data in sections])
+
+
+class Collector(object):
+    def __init__(self, log_file="", log_grep_freq=1, gc_log_file="", data_dirs=""):
+        self.log_grep_freq = log_grep_freq
+        self.data_dirs = [path for path in data_dirs.split(",") if path != ""]
+        self.stat = ProcFile("/proc/stat")
+        self.diskstats = ProcFile("/proc/diskstats")
+        self.net_dev = ProcFile("/proc/net/dev")
+        self.snmp = ProcFile("/proc/net/snmp")
+        self.log = FileFollower(log_file) if log_file else None
+        self.gc_log = FileFollower(gc_log_file) if gc_log_file else None
+        self.idx = -1
+
+    def sample(self):
+        self.idx += 1
+        stat = self.stat.read()
+        #Only the cpu lines (aggregated, then one per core) are used, skip the intr and softirq lines that follow
+        end = stat.find(b"\nintr ")
+        sections = [(b"stat", stat if end == -1 else stat[:end]), (b"diskstats", self.diskstats.read()), (b"netdev", self.net_dev.read())]
+        sections.append((b"snmp", b"\n".join([line for line in self.snmp.read().split(b"\n") if line.startswith(b"Tcp:")])))
+        sections.append((b"date", str(int(time.time() * 1000)).encode()))
+        log = b""
+        if self.log is not None and self.idx % self.log_grep_freq == 0:
+            errors = 0
+            warns = 0
+            try:
+                for data in self.log.read():
+                    chunk_errors, chunk_warns = count_levels(data)
+                    errors += chunk_errors
+                    warns += chunk_warns
+                log = ("%d %d" % (errors, warns)).encode()
+            except (IOError, OSError):
+                pass
+        sections.append((b"log", log))
+        stops = []
+        if self.gc_log is not None:
+            try:
+                for data in self.gc_log.read():
+                    stops.extend(gc_stops(data))
+            except (IOError, OSError):
+                pass
+        sections.append((b"gc", b"\n".join(stops)))
+        #Device (hexadecimal st_dev) of each data directory, like stat -Lc "%D %n"
+        dirs = []
+        for path in self.data_dirs:
+            try:
+                dirs.append(("%x %s" % (os.stat(path).st_dev, path)).encode())
+            except OSError:
+                pass
+        sections.append((b"dirs", b"\n".join(dirs)))
+        return frame(sections)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    collector = Collector(args.log_file, args.log_grep_freq, args.gc_log_file, args.data_dirs)
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    next_tick = time.time()
+    while True:
+        out.write(collector.sample())
+        out.flush()
+        next_tick += args.measure_frequency
+        delay = next_tick - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_tick = time.time()
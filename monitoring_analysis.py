@@ -0,0 +1,263 @@
+#Analysis of the captures of monitoring.py (csv from --dump, or binary recording from --dump_format=binary), eg:
+#  python monitoring_analysis.py monitoring-xxx.csv --breach="r_await>100:30"
+#lists the hosts whose r_await was over 100ms for more than 30 sec.
+#The capture is read once, row by row (or chunk by chunk for a recording), and never loaded in memory: the percentiles
+#are computed from log histograms (constant memory per host and metric, 1% relative error), so multi-GB captures
+#are analysed with a few MB of memory.
+#Must run with python 2.7 and python 3, standard library only.
+import argparse
+import csv
+import datetime
+import math
+import sys
+import monitoring_recording
+
+parser = argparse.ArgumentParser(description='Analyse a capture of monitoring.py: per host summary, top hosts and threshold breaches')
+parser.add_argument('capture', type=str, help='csv file written by --dump, or binary recording written by --dump_format=binary')
+parser.add_argument('--metrics', type=str, default="cpu-avg,avgqu-sz,r_await,w_await,gc_total_ms,disk_util", help='columns to summarize, eg: cpu-avg,r_await')
+parser.add_argument('--top', type=int, default=10, help='number of hosts listed for each metric, the hosts with the highest p99 first. 0 for all the hosts.')
+parser.add_argument('--breach', type=str, default="", help='time ranges where a metric is over (>) or under (<) a threshold for at least N sec, eg: "r_await>100:30,cpu-avg>0.9:60". Several separated by ","')
+parser.add_argument('--max_gap', type=float, default=5, help='a breach is interrupted when no measure of the host is received for this long (in sec).')
+parser.add_argument('--hosts', type=str, default="", help='only the rows of these hosts, eg: 127.0.0.1,127.0.0.2')
+parser.add_argument('--measure_frequency', type=float, default=1, help='for old csv files without timestamp column: the measures of each host are considered this far apart (in sec).')
+
+#Columns of the captures which aren't metrics
+NOT_METRICS = ("host", "timestamp", "disk_util_device")
+
+#Relative width of the buckets of the histograms
+HISTOGRAM_RATIO = 1.02
+LOG_RATIO = math.log(HISTOGRAM_RATIO)
+
+
+class Histogram(object):
+    #Count of the values by log bucket ([ratio^n, ratio^(n+1)[), the values <= 0 are counted apart.
+    #The percentiles are the middle of their bucket, within 1% of the exact value.
+    __slots__ = ("buckets", "zeros", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += 1
+        else:
+            bucket = int(math.floor(math.log(value) / LOG_RATIO))
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.zeros += other.zeros
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def percentiles(self, percents):
+        #Values of the sorted percents (0 -> 100)
+        values = []
+        ranks = [max(1, int(math.ceil(percent / 100.0 * self.count))) for percent in percents]
+        seen = self.zeros
+        buckets = sorted(self.buckets.items())
+        idx = 0
+        for rank in ranks:
+            if rank <= self.zeros:
+                values.append(0.0 if self.min >= 0 else self.min)
+                continue
+            while idx < len(buckets) and seen < rank:
+                seen += buckets[idx][1]
+                idx += 1
+            value = HISTOGRAM_RATIO ** (buckets[idx - 1][0] + 0.5)
+            values.append(min(self.max, max(self.min, value)))
+        return values
+
+    def average(self):
+        return self.total / self.count
+
+
+class Breach(object):
+    #Time ranges where a metric of a host is over or under a threshold
+    def __init__(self, definition, max_gap):
+        condition, duration = definition.rsplit(":", 1)
+        self.over = ">" in condition
+        self.metric, threshold = condition.split(">" if self.over else "<")
+        if self.metric == "":
+            raise ValueError("no metric in "+definition)
+        self.threshold = float(threshold)
+        self.duration = float(duration) * 1000
+        self.max_gap = max_gap * 1000
+        #host: [start, last timestamp, worst value] of the range in progress. Each row is measured over the interval since
+        #the previous row of the host: a range starts at the previous row.
+        self.current = {}
+        self.last_seen = {}
+        #(host, start, end, worst value) of the ranges long enough
+        self.ranges = []
+
+    def add(self, host, timestamp, value):
+        current = self.current.get(host)
+        last_seen = self.last_seen.get(host)
+        self.last_seen[host] = timestamp
+        if current is not None and (last_seen is None or timestamp - last_seen > self.max_gap):
+            self.close(host)
+            current = None
+        if value == value and (value > self.threshold if self.over else value < self.threshold):
+            if current is None:
+                start = timestamp if last_seen is None or timestamp - last_seen > self.max_gap else last_seen
+                self.current[host] = [start, timestamp, value]
+            else:
+                current[1] = timestamp
+                current[2] = max(current[2], value) if self.over else min(current[2], value)
+        elif current is not None:
+            self.close(host)
+
+    def close(self, host):
+        start, end, worst = self.current.pop(host)
+        if end - start >= self.duration:
+            self.ranges.append((host, start, end, worst))
+
+    def finish(self):
+        for host in list(self.current.keys()):
+            self.close(host)
+
+
+def read_csv(path, hosts, names, measure_frequency):
+    #(host, timestamp in ms, {column: value}) of each row, only the columns in names are parsed. The unknown values (-1) are skipped
+    with open(path, 'rb' if sys.version_info[0] < 3 else 'r') as capture:
+        reader = csv.reader(capture)
+        header = next(reader)
+        timestamp_column = header.index("timestamp") if "timestamp" in header else None
+        columns = [(idx, name) for idx, name in enumerate(header) if name in names]
+        #Old captures without timestamp: each row of a host is measure_frequency after the previous one
+        rows = {}
+        for row in reader:
+            if len(row) < len(header) or (hosts is not None and row[0] not in hosts):
+                continue
+            if timestamp_column is None:
+                rows[row[0]] = rows.get(row[0], -1) + 1
+                timestamp = rows[row[0]] * measure_frequency * 1000
+            else:
+                timestamp = float(row[timestamp_column])
+            values = {}
+            for idx, name in columns:
+                value = float(row[idx])
+                if value != -1:
+                    values[name] = value
+            yield row[0], timestamp, values
+
+
+def read_recording(path, hosts, names):
+    recording = monitoring_recording.Recording(path)
+    columns = [(idx, name) for idx, name in enumerate(recording.columns) if name in names]
+    try:
+        for host, timestamp, row, device in recording.records(hosts):
+            yield host, timestamp, dict([(name, row[idx]) for idx, name in columns if row[idx] == row[idx]])
+    finally:
+        recording.close()
+
+
+def capture_columns(path, binary):
+    if binary:
+        recording = monitoring_recording.Recording(path)
+        recording.close()
+        return recording.columns
+    with open(path, 'rb' if sys.version_info[0] < 3 else 'r') as capture:
+        return next(csv.reader(capture), [])
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp / 1000.0).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def analyse(rows, metrics, breaches):
+    #Single pass on the rows: histogram of each metric of each host, breaches
+    histograms = dict((metric, {}) for metric in metrics)
+    first = None
+    last = None
+    count = 0
+    for host, timestamp, values in rows:
+        count += 1
+        if first is None or timestamp < first:
+            first = timestamp
+        if last is None or timestamp > last:
+            last = timestamp
+        for metric in metrics:
+            value = values.get(metric)
+            if value is not None:
+                host_histograms = histograms[metric]
+                if host not in host_histograms:
+                    host_histograms[host] = Histogram()
+                host_histograms[host].add(value)
+        for breach in breaches:
+            breach.add(host, timestamp, values.get(breach.metric, float("nan")))
+    for breach in breaches:
+        breach.finish()
+    return histograms, count, first, last
+
+
+def report(histograms, count, first, last, breaches, top):
+    lines = []
+    if count == 0:
+        return ["no measure in the capture"]
+    lines.append(str(count)+" measures from "+format_time(first)+" to "+format_time(last))
+    header = "host".ljust(20, " ")+"".join([column.ljust(11, " ") for column in ("count", "avg", "min", "p50", "p95", "p99", "max")])
+    for metric, host_histograms in sorted(histograms.items()):
+        lines.append("")
+        if len(host_histograms) == 0:
+            lines.append(metric.upper()+": no value")
+            continue
+        cluster = Histogram()
+        hosts = []
+        for host, histogram in host_histograms.items():
+            cluster.merge(histogram)
+            hosts.append((histogram.percentiles([99])[0], host, histogram))
+        hosts.sort(key=lambda host: (-host[0], host[1]))
+        lines.append(metric.upper()+(" (all the hosts, highest p99 first)" if top <= 0 or top >= len(hosts) else " (top "+str(top)+" of "+str(len(hosts))+" hosts by p99)"))
+        lines.append(header)
+        lines.append("".ljust(len(header), "-"))
+        for name, histogram in [("all hosts", cluster)] + [(host, histogram) for p99, host, histogram in (hosts if top <= 0 else hosts[:top])]:
+            values = [histogram.average(), histogram.min] + histogram.percentiles([50, 95, 99]) + [histogram.max]
+            lines.append(name.ljust(20, " ")+str(histogram.count).ljust(11, " ")+"".join([("%.3f" % value).ljust(11, " ") for value in values]))
+    for breach in breaches:
+        lines.append("")
+        lines.append(breach.metric+(" > " if breach.over else " < ")+("%g" % breach.threshold)+" for at least "+("%g" % (breach.duration / 1000))+" sec: "+str(len(breach.ranges))+" range(s)")
+        for host, start, end, worst in sorted(breach.ranges, key=lambda breach_range: (breach_range[1], breach_range[0])):
+            lines.append("  "+host.ljust(20, " ")+format_time(start)+" -> "+format_time(end)+"  "+("%d" % ((end - start) / 1000)).rjust(6, " ")+" sec  "+("max" if breach.over else "min")+" %.3f" % worst)
+    return lines
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    metrics = [metric for metric in args.metrics.replace(" ", "").split(",") if metric != ""]
+    try:
+        breaches = [Breach(definition, args.max_gap) for definition in args.breach.replace(" ", "").split(",") if definition != ""]
+    except ValueError:
+        parser.error("invalid --breach "+args.breach+', expected <metric>(>|<)<threshold>:<seconds>, eg: "r_await>100:30,cpu-avg>0.9:60"')
+    hosts = None if args.hosts == "" else frozenset(args.hosts.replace(" ", "").split(","))
+    with open(args.capture, 'rb') as capture:
+        start = capture.read(len(monitoring_recording.MAGIC))
+    if len(start) == 0:
+        sys.exit(args.capture+" is empty")
+    binary = start == monitoring_recording.MAGIC
+    names = frozenset(metrics + [breach.metric for breach in breaches])
+    try:
+        columns = capture_columns(args.capture, binary)
+    except ValueError as ex:
+        sys.exit(str(ex))
+    unknown = sorted([name for name in names if name not in columns or name in NOT_METRICS])
+    if len(unknown) > 0:
+        sys.exit("Metric(s) "+", ".join(unknown)+" not found in "+args.capture+". Metrics: "+", ".join([column for column in columns if column not in NOT_METRICS]))
+    rows = read_recording(args.capture, hosts, names) if binary else read_csv(args.capture, hosts, names, args.measure_frequency)
+    histograms, count, first, last = analyse(rows, metrics, breaches)
+    for line in report(histograms, count, first, last, breaches, args.top):
+        print(line)
@@ -0,0 +1,257 @@
+#Binary recording of the measures of monitoring.py (--dump_format=binary), much smaller and faster to write than the csv.
+#The file is append only:
+#  header: MONREC1\n, then 2 length prefixed (uint32) blocks: the hosts and the columns ("name format"), one per line
+#  chunks: CHNK, number of records, size of the chunk after its header, first and last timestamp (ms), bitmap of the hosts present
+#          followed by the records of the chunk stored by column: timestamps (double), hosts (uint16, index in the hosts),
+#          busiest device (uint16, index in the names of the chunk), one float32 array per column (NaN when unknown, 7
+#          significant digits, enough for the metrics and half the size of doubles),
+#          then the device names of the chunk (one per line).
+#All the numbers are little endian. The chunk headers are the index of the file: the reader skips the chunks outside of the
+#requested time range or without the requested hosts, and the columns can be used in place (numpy.frombuffer(mmap, "<f4", offset=...)).
+#A chunk cut by a crash (incomplete size) is ignored.
+#Must run with python 2.7 and python 3, standard library only.
+import argparse
+import array
+import csv
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"MONREC1\n"
+CHUNK_MAGIC = b"CHNK"
+#magic, records, size of the chunk after the header, first timestamp, last timestamp
+CHUNK_HEADER = struct.Struct("<4sIIdd")
+BLOCK_SIZE = struct.Struct("<I")
+
+
+def little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def to_bytes(values):
+    little_endian(values)
+    data = values.tostring() if sys.version_info[0] < 3 else values.tobytes()
+    little_endian(values)
+    return data
+
+
+def from_bytes(typecode, data):
+    values = array.array(typecode)
+    if sys.version_info[0] < 3:
+        values.fromstring(data)
+    else:
+        values.frombytes(data)
+    return little_endian(values)
+
+
+def block(lines):
+    data = u"\n".join(lines).encode("utf-8")
+    return BLOCK_SIZE.pack(len(data)) + data
+
+
+class RecordingWriter(object):
+    #Records are buffered by column and written as a chunk every chunk_size records or at each flush
+    def __init__(self, path, hosts, columns, formats, chunk_size=4096):
+        self.hosts = list(hosts)
+        self.host_index = dict((host, idx) for idx, host in enumerate(self.hosts))
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + block(self.hosts) + block([name + " " + fmt for name, fmt in zip(self.columns, formats)]))
+        #The header is on the disk as soon as the recording starts, so that it can be read during the capture
+        self.file.flush()
+        self.clear()
+
+    def clear(self):
+        self.timestamps = array.array("d")
+        self.host_ids = array.array("H")
+        self.device_ids = array.array("H")
+        self.values = [array.array("f") for column in self.columns]
+        self.devices = []
+        self.device_index = {}
+
+    def append(self, host, timestamp, values, device=""):
+        #values: one float per column, in the order of the columns
+        device_id = self.device_index.get(device)
+        if device_id is None:
+            device_id = self.device_index[device] = len(self.devices)
+            self.devices.append(device)
+        self.timestamps.append(timestamp)
+        self.host_ids.append(self.host_index[host])
+        self.device_ids.append(device_id)
+        for column, value in zip(self.values, values):
+            column.append(value)
+        if len(self.timestamps) >= self.chunk_size:
+            self.write_chunk()
+
+    def write_chunk(self):
+        count = len(self.timestamps)
+        if count == 0:
+            return
+        bitmap = bytearray((len(self.hosts) + 7) // 8)
+        for host_id in set(self.host_ids):
+            bitmap[host_id // 8] |= 1 << (host_id % 8)
+        body = [bytes(bitmap), to_bytes(self.timestamps), to_bytes(self.host_ids), to_bytes(self.device_ids)]
+        body.extend([to_bytes(column) for column in self.values])
+        body.append(block(self.devices))
+        body = b"".join(body)
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, count, len(body), min(self.timestamps), max(self.timestamps)) + body)
+        self.clear()
+
+    def flush(self):
+        self.write_chunk()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Chunk(object):
+    __slots__ = ("offset", "count", "first", "last", "hosts")
+
+    def __init__(self, offset, count, first, last, hosts):
+        #offset of the timestamps column in the file
+        self.offset = offset
+        self.count = count
+        self.first = first
+        self.last = last
+        #indexes of the hosts present in the chunk
+        self.hosts = hosts
+
+
+class Recording(object):
+    #Memory mapped recording, the chunk headers are read when it's opened
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        if os.fstat(self.file.fileno()).st_size < len(MAGIC) + 2 * BLOCK_SIZE.size:
+            self.file.close()
+            raise ValueError(path + " is empty or truncated, not a complete recording of monitoring.py")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(path + " isn't a recording of monitoring.py")
+        offset = len(MAGIC)
+        try:
+            self.hosts, offset = self.read_block(offset)
+            columns, offset = self.read_block(offset)
+        except ValueError:
+            self.close()
+            raise ValueError(path + " is truncated, its header is incomplete")
+        self.columns = [column.rsplit(" ", 1)[0] for column in columns]
+        self.formats = [column.rsplit(" ", 1)[1] for column in columns]
+        self.column_index = dict((name, idx) for idx, name in enumerate(self.columns))
+        bitmap_size = (len(self.hosts) + 7) // 8
+        self.chunks = []
+        while offset + CHUNK_HEADER.size <= len(self.map):
+            magic, count, size, first, last = CHUNK_HEADER.unpack_from(self.map, offset)
+            offset += CHUNK_HEADER.size
+            if magic != CHUNK_MAGIC or offset + size > len(self.map):
+                break
+            bitmap = bytearray(self.map[offset:offset + bitmap_size])
+            hosts = frozenset([idx for idx in range(len(self.hosts)) if bitmap[idx // 8] & (1 << (idx % 8))])
+            self.chunks.append(Chunk(offset + bitmap_size, count, first, last, hosts))
+            offset += size
+
+    def read_block(self, offset):
+        if offset + BLOCK_SIZE.size > len(self.map):
+            raise ValueError("block after the end of the file")
+        size = BLOCK_SIZE.unpack_from(self.map, offset)[0]
+        offset += BLOCK_SIZE.size
+        if offset + size > len(self.map):
+            raise ValueError("block after the end of the file")
+        data = self.map[offset:offset + size].decode("utf-8")
+        return data.split(u"\n") if data != u"" else [], offset + size
+
+    def column_offset(self, chunk, name):
+        #Offset of the values of a column in the file, eg: numpy.frombuffer(recording.map, "<f4", chunk.count, offset)
+        return chunk.offset + chunk.count * (8 + 2 + 2) + self.column_index[name] * chunk.count * 4
+
+    def select(self, hosts=None, start=None, end=None):
+        #Chunks which may contain records of the hosts (names) between start and end (ms)
+        host_ids = None if hosts is None else frozenset([self.hosts.index(host) for host in hosts if host in self.hosts])
+        for chunk in self.chunks:
+            if (start is not None and chunk.last < start) or (end is not None and chunk.first > end):
+                continue
+            if host_ids is not None and chunk.hosts.isdisjoint(host_ids):
+                continue
+            yield chunk
+
+    def read_chunk(self, chunk):
+        #Columns of the chunk: timestamps, hosts ids, device ids, values (one array per column), device names
+        count = chunk.count
+        offset = chunk.offset
+        timestamps = from_bytes("d", self.map[offset:offset + count * 8])
+        offset += count * 8
+        host_ids = from_bytes("H", self.map[offset:offset + count * 2])
+        offset += count * 2
+        device_ids = from_bytes("H", self.map[offset:offset + count * 2])
+        offset += count * 2
+        values = []
+        for column in self.columns:
+            values.append(from_bytes("f", self.map[offset:offset + count * 4]))
+            offset += count * 4
+        devices, offset = self.read_block(offset)
+        return timestamps, host_ids, device_ids, values, devices
+
+    def records(self, hosts=None, start=None, end=None):
+        #(host, timestamp, values, device) of each record, in the order they were written
+        hosts = None if hosts is None else frozenset(hosts)
+        for chunk in self.select(hosts, start, end):
+            timestamps, host_ids, device_ids, values, devices = self.read_chunk(chunk)
+            for idx, row in enumerate(zip(*values)):
+                host = self.hosts[host_ids[idx]]
+                timestamp = timestamps[idx]
+                if (hosts is not None and host not in hosts) or (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                    continue
+                yield host, timestamp, row, devices[device_ids[idx]]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def csv_row(host, timestamp, values, device, formats, device_column):
+    #Same row as the csv dump of monitoring.py: the unknown values are written as -1,
+    #the busiest device after the column device_column (disk_util)
+    row = [host, "%d" % timestamp]
+    for idx, (fmt, value) in enumerate(zip(formats, values)):
+        row.append(-1 if value != value else fmt % value)
+        if idx == device_column:
+            row.append(device)
+    return row
+
+
+def to_csv(recording, out, hosts=None, start=None, end=None):
+    writer = csv.writer(out, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    device_column = recording.column_index.get("disk_util", -1)
+    header = ["host", "timestamp"] + recording.columns
+    if device_column >= 0:
+        header.insert(device_column + 3, "disk_util_device")
+    writer.writerow(header)
+    for host, timestamp, values, device in recording.records(hosts, start, end):
+        writer.writerow(csv_row(host, timestamp, values, device, recording.formats, device_column))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a recording of monitoring.py (--dump_format=binary) to its csv layout')
+    parser.add_argument('recording', type=str, help='recording file')
+    parser.add_argument('--to_csv', type=str, default="", help='csv file to write, the standard output if empty')
+    parser.add_argument('--hosts', type=str, default="", help='only the records of these hosts, eg: 127.0.0.1,127.0.0.2')
+    parser.add_argument('--start', type=float, default=None, help='only the records measured after this timestamp (ms)')
+    parser.add_argument('--end', type=float, default=None, help='only the records measured before this timestamp (ms)')
+    args = parser.parse_args()
+    try:
+        recording = Recording(args.recording)
+    except ValueError as ex:
+        sys.exit(str(ex))
+    hosts = None if args.hosts == "" else args.hosts.replace(" ", "").split(",")
+    if args.to_csv == "":
+        to_csv(recording, sys.stdout, hosts, args.start, args.end)
+    else:
+        with open(args.to_csv, 'wb' if sys.version_info[0] < 3 else 'w') as out:
+            to_csv(recording, out, hosts, args.start, args.end)
+    recording.close()
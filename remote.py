@@ -0,0 +1,271 @@
+#Shared by monitoring.py, check-cassandra-config.py and check-os-config.py.
+#Runs the ssh processes of all the hosts from a single thread: their stdout are read with non blocking os.read
+#and multiplexed with select.poll, so watching a 1000+ nodes fleet doesn't need one thread per host.
+import collections
+import errno
+import fcntl
+import heapq
+import os
+import random
+import select
+import subprocess
+import sys
+import time
+import traceback
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+class Stream:
+    def __init__(self, name, process, on_data, on_close):
+        self.name = name
+        self.process = process
+        self.on_data = on_data
+        self.on_close = on_close
+        self.fd = process.stdout.fileno()
+
+
+class RemoteLoop:
+    #Event loop reading the output of the ssh processes and running the scheduled calls (call_later).
+    #All the callbacks are executed from the thread running the loop. An exception raised by a callback is reported to
+    #on_error(message) (stderr by default) and doesn't stop the loop: the stream whose on_data failed is closed.
+    def __init__(self, on_error=None):
+        self.poller = select.poll()
+        self.streams = {}
+        self.timers = []
+        self.timer_seq = 0
+        self.on_error = on_error
+
+    def error(self, message):
+        message += ": " + traceback.format_exc().strip().split("\n")[-1]
+        if self.on_error is not None:
+            self.on_error(message)
+        else:
+            sys.stderr.write(message + "\n")
+
+    def add(self, name, process, on_data, on_close=None):
+        #on_data(name, data) is called with each chunk read from the process stdout,
+        #on_close(name, returncode) once the process has closed its stdout and exited.
+        stream = Stream(name, process, on_data, on_close)
+        flags = fcntl.fcntl(stream.fd, fcntl.F_GETFL)
+        fcntl.fcntl(stream.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.streams[stream.fd] = stream
+        self.poller.register(stream.fd, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+        return stream
+
+    def call_later(self, delay, method, *args):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_seq, method, args))
+
+    def close(self, stream):
+        self.poller.unregister(stream.fd)
+        del self.streams[stream.fd]
+        stream.process.stdout.close()
+        returncode = stream.process.wait()
+        if stream.on_close is not None:
+            try:
+                stream.on_close(stream.name, returncode)
+            except Exception:
+                self.error("error closing the stream of " + str(stream.name))
+
+    def run_timers(self):
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            _, _, method, args = heapq.heappop(self.timers)
+            try:
+                method(*args)
+            except Exception:
+                self.error("error in the scheduled call " + getattr(method, "__name__", str(method)))
+
+    def run_once(self, max_wait=None):
+        self.run_timers()
+        timeout = max_wait
+        if len(self.timers) > 0:
+            next_timer = max(0, self.timers[0][0] - time.time())
+            timeout = next_timer if timeout is None else min(timeout, next_timer)
+        events = self.poller.poll(None if timeout is None else timeout * 1000)
+        for fd, event in events:
+            stream = self.streams.get(fd)
+            if stream is None:
+                continue
+            try:
+                data = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                data = b""
+            if data:
+                try:
+                    stream.on_data(stream.name, data)
+                except Exception:
+                    self.error("error reading the stream of " + str(stream.name) + ", closing it")
+                    try:
+                        stream.process.kill()
+                    except OSError:
+                        pass
+                    self.close(stream)
+            else:
+                self.close(stream)
+        self.run_timers()
+
+    def run(self):
+        #Until all the processes are done and no call is scheduled
+        while len(self.streams) > 0 or len(self.timers) > 0:
+            self.run_once()
+
+    def run_forever(self):
+        while True:
+            self.run_once(1)
+
+
+CONNECTING = "connecting"
+STREAMING = "streaming"
+BACKING_OFF = "backing off"
+
+
+class ReconnectScheduler:
+    #Restart the broken streams with a jittered exponential backoff (min_delay, x2 at each failure, +/-50%
+    #random so that all the hosts don't reconnect in the same second after a network blip, capped at max_delay), with at most max_concurrent
+    #connections in progress at the same time, including the first connections started with start(host).
+    #connect(host) is called to (re)start a stream, the owner of the stream must then call connected(host) when it
+    #receives its first data and closed(host) when it stops.
+    #A stream still connecting after connect_timeout sec (password prompt, hung command...) would keep its connection slot
+    #forever: cancel(host) is called, it must stop the stream, which then calls closed(host) and backs off.
+    def __init__(self, loop, connect, min_delay=1, max_delay=60, max_concurrent=50, stable_after=60, connect_timeout=60, cancel=None):
+        self.loop = loop
+        self.connect = connect
+        self.connect_timeout = connect_timeout
+        self.cancel = cancel
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_concurrent = max_concurrent
+        #A stream is considered stable (failures reset) once it has been streaming for this long
+        self.stable_after = stable_after
+        self.state = {}
+        self.failures = {}
+        self.retry_at = {}
+        self.streaming_since = {}
+        self.connecting = set()
+        #Number of connections started for each host, to ignore the timeouts of the previous ones
+        self.attempts = collections.defaultdict(int)
+        self.waiting = collections.deque()
+
+    def start(self, host):
+        self.failures[host] = 0
+        self.state[host] = CONNECTING
+        self.waiting.append(host)
+        self.pump()
+
+    def connected(self, host):
+        self.connecting.discard(host)
+        self.state[host] = STREAMING
+        self.streaming_since[host] = time.time()
+        self.pump()
+
+    def closed(self, host):
+        self.connecting.discard(host)
+        since = self.streaming_since.pop(host, None)
+        if since is not None and time.time() - since > self.stable_after:
+            self.failures[host] = 0
+        self.failures[host] += 1
+        delay = min(self.max_delay, self.min_delay * 2 ** (self.failures[host] - 1) * random.uniform(0.5, 1.5))
+        self.state[host] = BACKING_OFF
+        self.retry_at[host] = time.time() + delay
+        self.loop.call_later(delay, self.ready, host)
+        self.pump()
+
+    def ready(self, host):
+        self.waiting.append(host)
+        self.pump()
+
+    def pump(self):
+        while len(self.waiting) > 0 and len(self.connecting) < self.max_concurrent:
+            host = self.waiting.popleft()
+            self.state[host] = CONNECTING
+            self.connecting.add(host)
+            self.attempts[host] += 1
+            if self.cancel is not None:
+                self.loop.call_later(self.connect_timeout, self.check_connected, host, self.attempts[host])
+            self.connect(host)
+
+    def check_connected(self, host, attempt):
+        if host in self.connecting and self.attempts[host] == attempt:
+            self.cancel(host)
+
+    def describe(self, host):
+        state = self.state.get(host, CONNECTING)
+        if state == CONNECTING and host not in self.connecting:
+            return "waiting for a connection slot"
+        if state == BACKING_OFF:
+            if self.retry_at[host] <= time.time():
+                return "backing off after "+str(self.failures[host])+" failure(s), waiting for a connection slot"
+            return "backing off after "+str(self.failures[host])+" failure(s), retry in "+str(max(0, int(self.retry_at[host] - time.time())))+"s"
+        return state
+
+
+class Ssh:
+    #Build the ssh commands of the tools. With persist > 0, all the connections to a host share a single ssh connection
+    #(ControlMaster): the master is kept in background for persist seconds after its last use, so the handshake is done
+    #once per host, even across successive invocations of the tools.
+    def __init__(self, user, key, persist=0, control_dir="~/.ssh/cassandra-troubleshooting", options=""):
+        self.user = user
+        self.key = key
+        self.persist = persist
+        #%C: hash of the user, host and port, a socket path of user@long.host.name:port would exceed the ~104 bytes
+        #limit of the unix sockets
+        self.control_path = os.path.join(os.path.expanduser(control_dir), "%C")
+        self.options = options
+        if persist > 0 and not os.path.isdir(os.path.dirname(self.control_path)):
+            os.makedirs(os.path.dirname(self.control_path), 0o700)
+
+    def base(self, host, multiplex_options):
+        #BatchMode: fail instead of waiting for a password or a passphrase on a prompt nobody sees
+        command = "ssh -o StrictHostKeyChecking=no -o ConnectTimeout=10 -o BatchMode=yes "+("" if self.options == "" else self.options+" ")+("" if self.key == "" else "-i "+quote(os.path.expanduser(self.key))+" ")
+        if self.persist > 0:
+            command += "-o ControlPath="+quote(self.control_path)+" "+multiplex_options+" "
+        return command+quote(self.user+"@"+host)
+
+    def command(self, host, command):
+        #Use the master connection of the host if there is one, a direct connection otherwise
+        return self.base(host, "-o ControlMaster=auto")+" "+quote(command)
+
+    def master_command(self, host):
+        #Open the master connection of the host if it doesn't exist yet (noop otherwise)
+        if self.persist <= 0:
+            return None
+        return self.base(host, "-o ControlMaster=auto -o ControlPersist="+str(int(self.persist))+" -n")+" true < /dev/null > /dev/null 2>&1"
+
+    def open_masters(self, hosts, max_running=50):
+        #Open the master connections of all the hosts before running several commands per host,
+        #otherwise concurrent commands on the same host would all try to become the master.
+        if self.persist > 0:
+            run_commands([(host, self.master_command(host)) for host in hosts], lambda host, lines: None, max_running)
+
+
+def execute(command, stdin=None):
+    return subprocess.Popen(command, shell=True, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def run_commands(commands, method, max_running=50):
+    #Execute the (key, command), max_running at the same time, call method(key, lines) as soon as one is done.
+    loop = RemoteLoop()
+    outputs = {}
+    pending = collections.deque(commands)
+
+    def on_data(key, data):
+        outputs[key].append(data)
+
+    def on_close(key, returncode):
+        method(key, b"".join(outputs.pop(key)).splitlines(True))
+        start_next()
+
+    def start_next():
+        while len(pending) > 0 and len(loop.streams) < max_running:
+            key, command = pending.popleft()
+            outputs[key] = []
+            loop.add(key, execute(command), on_data, on_close)
+
+    start_next()
+    loop.run()